@@ -0,0 +1,12 @@
+import os
+
+import pytest
+
+from traktor_s4_mk1_midify import midify
+
+
+# Every test translates with the packaged mappings, compiled into a cache of their own rather than the user's
+@pytest.fixture(autouse=True, scope="session")
+def mappings(tmp_path_factory):
+    os.environ["XDG_CACHE_HOME"] = str(tmp_path_factory.mktemp("cache"))
+    midify.load_mappings()
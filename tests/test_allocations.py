@@ -0,0 +1,34 @@
+import tracemalloc
+
+from traktor_s4_mk1_midify import midify
+from traktor_s4_mk1_midify.bench import fader_sweep_workload, jog_scratch_workload
+from traktor_s4_mk1_midify.recording import MidiSink
+
+
+# Once everything has been warmed up, processing controller events shouldn't allocate anything that outlives the event
+# (each allocation that sticks around is more work for the garbage collector in the middle of a set).
+def test_steady_state_allocations():
+    events = jog_scratch_workload(25000) + fader_sweep_workload(25000)
+    events.sort(key=midify.event_time_ns)
+    state = midify.create_state(5000000)
+    sink = MidiSink()
+
+    def process(events):
+        for event in events:
+            midify.process_event(event, state, sink)
+            midify.flush_encoders(state, sink, midify.event_time_ns(event))
+
+    # Later passes continue from where the first one left off, as a long set would
+    process(events)
+    tracemalloc.start()
+
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        process(events)
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert after - before <= 1024, f"Processing events retained {after - before} bytes"
+    assert peak - before <= 4096, f"Processing events needed up to {peak - before} bytes at once"
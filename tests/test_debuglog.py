@@ -0,0 +1,31 @@
+from traktor_s4_mk1_midify.debuglog import LOG_EVENT, LOG_RECEIVED, LOG_SENT, DebugLog
+
+
+# A started log that won't write anything out until it's stopped, so that its records can be checked first
+def started_log(filename, **filters):
+    debug_log = DebugLog(filename, interval=60, **filters)
+    debug_log.start()
+    return debug_log
+
+
+def logged(debug_log):
+    return [record[:5] for record in debug_log.records]
+
+
+# The event code filter mustn't hide received MIDI messages, and the CC filter mustn't hide controller events, since
+# neither has that field.
+def test_filters_only_apply_to_records_with_their_field(tmp_path):
+    debug_log = started_log(tmp_path / "evcodes.log", evcodes={52})
+    debug_log.log(LOG_EVENT, 52, -1, -1, 1)
+    debug_log.log(LOG_EVENT, 53, -1, -1, 1)
+    debug_log.log(LOG_SENT, 53, 0xB0, 0x46, 1)
+    debug_log.log(LOG_RECEIVED, -1, 0xB0, 0x46, 1)
+    assert logged(debug_log) == [(LOG_EVENT, 52, -1, -1, 1), (LOG_RECEIVED, -1, 0xB0, 0x46, 1)]
+    debug_log.stop()
+
+    debug_log = started_log(tmp_path / "ccs.log", ccs={0x46})
+    debug_log.log(LOG_EVENT, 52, -1, -1, 1)
+    debug_log.log(LOG_SENT, 52, 0xB0, 0x47, 1)
+    debug_log.log(LOG_RECEIVED, -1, 0xB0, 0x46, 1)
+    assert logged(debug_log) == [(LOG_EVENT, 52, -1, -1, 1), (LOG_RECEIVED, -1, 0xB0, 0x46, 1)]
+    debug_log.stop()
@@ -0,0 +1,28 @@
+import itertools
+
+from traktor_s4_mk1_midify import midify
+
+
+# DISPATCH_TABLE must give the same MIDI status / CC as evcode_to_midi for every event code and modifier state.
+def test_dispatch_table_matches_evcode_to_midi():
+    for evcode, modifiers in itertools.product(range(len(midify.EVCODE_TYPE_MAP)), range(16)):
+        dispatch = midify.DISPATCH_TABLE[evcode << 4 | modifiers]
+
+        # evcode_to_midi assumes event codes without a mixer / effect mapping are in range for MIDI_MAP_DECK
+        if midify.EVCODE_TYPE_MAP[evcode] is None or (
+            midify.MIDI_MAP_MIXER_EFFECT[evcode] is None and evcode >= len(midify.MIDI_MAP_DECK)
+        ):
+            midi = None
+        else:
+            midi = midify.evcode_to_midi(
+                evcode,
+                bool(modifiers & midify.SHIFT_A),
+                bool(modifiers & midify.SHIFT_B),
+                bool(modifiers & midify.TOGGLE_AC),
+                bool(modifiers & midify.TOGGLE_BD),
+            )
+
+        if midi is None:
+            assert dispatch is None, f"evcode {evcode} modifiers {modifiers}: expected no mapping, got {dispatch}"
+        else:
+            assert dispatch[:2] == [midi[1], midi[0]], f"evcode {evcode} modifiers {modifiers}: {dispatch} != {midi}"
@@ -0,0 +1,76 @@
+import evdev
+
+from traktor_s4_mk1_midify import midify
+from traktor_s4_mk1_midify.recording import MidiSink
+
+SHIFT_A_EVCODE = 257
+PLAY_A_EVCODE = 260
+SHIFTED_POT_EVCODE = 21  # A pot with its own control while shift is held
+
+
+class OverflowedDevice:
+    """Stands in for a controller's evdev after SYN_DROPPED, with buttons and axes as they are now."""
+
+    def __init__(self, active_keys, axes):
+        self.keys = active_keys
+        self.axes = axes
+
+    def active_keys(self):
+        return self.keys
+
+    def capabilities(self, absinfo=True):
+        axes = [[code, evdev.AbsInfo(value, 0, 4095, 0, 0, 0)] for code, value in self.axes.items()]
+        return {evdev.ecodes.EV_KEY: [SHIFT_A_EVCODE, PLAY_A_EVCODE], evdev.ecodes.EV_ABS: axes}
+
+
+def key(code, value):
+    return evdev.InputEvent(0, 0, evdev.ecodes.EV_KEY, code, value)
+
+
+def axis(code, value):
+    return evdev.InputEvent(0, 0, evdev.ecodes.EV_ABS, code, value)
+
+
+def syn(code=evdev.ecodes.SYN_REPORT):
+    return evdev.InputEvent(0, 0, evdev.ecodes.EV_SYN, code, 0)
+
+
+def translate(events, device=None):
+    state = midify.create_state(5000000)
+    sink = MidiSink(keep=True)
+
+    for frame in midify.EventFrameCoalescer().feed(events):
+        midify.process_frame(frame, state, sink, device=device)
+
+    return sink.sent
+
+
+def control(evcode, modifiers=0):
+    return midify.DISPATCH_TABLE[evcode << 4 | modifiers][:2]
+
+
+# A pot moved before and after shift is pressed in the same frame should send its value on both controls, rather than
+# its last value on the unshifted one.
+def test_axis_values_are_not_coalesced_past_modifiers():
+    sent = translate([axis(SHIFTED_POT_EVCODE, 1000), key(SHIFT_A_EVCODE, 1), axis(SHIFTED_POT_EVCODE, 3000), syn()])
+
+    assert sent == [
+        [*control(SHIFTED_POT_EVCODE), 1000 // 32],
+        [*control(SHIFTED_POT_EVCODE, midify.SHIFT_A), 3000 // 32],
+    ]
+
+
+# A button release lost when the kernel's buffer overflowed should be sent once the state is read back from the device,
+# along with pots that moved in the meantime.
+def test_state_is_resynced_after_dropped_events():
+    events = [key(PLAY_A_EVCODE, 1), syn(), syn(evdev.ecodes.SYN_DROPPED), axis(SHIFTED_POT_EVCODE, 4095), syn()]
+    sent = translate(events, OverflowedDevice([], {SHIFTED_POT_EVCODE: 2000}))
+
+    assert sent == [
+        [*control(PLAY_A_EVCODE), 1],
+        [*control(PLAY_A_EVCODE), 0],
+        [*control(SHIFTED_POT_EVCODE), 2000 // 32],
+    ]
+
+    # Replaying a recording, there's nothing to read back
+    assert translate(events) == [[*control(PLAY_A_EVCODE), 1]]
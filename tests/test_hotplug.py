@@ -0,0 +1,132 @@
+import errno
+import os
+import tempfile
+import time
+
+import evdev
+
+from traktor_s4_mk1_midify import midify
+from traktor_s4_mk1_midify.bench import FADER_EVCODES
+from traktor_s4_mk1_midify.leds import LedFramebuffer, NullLedBackend
+from traktor_s4_mk1_midify.recording import MidiSink
+
+SHIFT_A_EVCODE = 257
+PLAY_A_EVCODE = 260
+
+
+class StandInDevice:
+    """
+    Stands in for a controller's evdev in test_hotplug: events are queued with push(), and after unplug() reads fail
+    the way they do for a controller that has been unplugged.
+    """
+
+    name = "Traktor Kontrol S4"
+
+    def __init__(self, path, phys, pots):
+        self.path = path
+        self.phys = phys
+        self.pots = pots
+        self.events = []
+        self.unplugged = False
+        self.read_fd, self.write_fd = os.pipe()
+        self.fd = self.read_fd
+
+    def fileno(self):
+        return self.read_fd
+
+    def push(self, events):
+        self.events.extend(events)
+        os.write(self.write_fd, b"\0")
+
+    def unplug(self):
+        self.unplugged = True
+        os.write(self.write_fd, b"\0")
+
+    # Like evdev's read(), this is a generator, so nothing is read (and nothing fails) until it's iterated
+    def read(self):
+        os.read(self.read_fd, 4096)
+
+        if self.unplugged:
+            raise OSError(errno.ENODEV, os.strerror(errno.ENODEV))
+
+        events, self.events = self.events, []
+        yield from events
+
+    def capabilities(self, absinfo=True):
+        pots = [[code, evdev.AbsInfo(value, 0, 4095, 0, 0, 0)] for code, value in self.pots.items()]
+        return {evdev.ecodes.EV_ABS: pots}
+
+    def close(self):
+        if self.read_fd is not None:
+            os.close(self.read_fd)
+            os.close(self.write_fd)
+            self.read_fd = self.write_fd = None
+
+
+# Unplug a (stand-in) controller with shift and play held down and plug it back in with a fader moved, checking that
+# the supervisor reattaches it within a second of it appearing in the input directory, with buttons released, the pot
+# resynced and the LEDs that Mixxx had lit written again.
+def test_hotplug():
+    fader = FADER_EVCODES[0]
+    device = StandInDevice("/dev/input/event6", "usb-0000:07:00.0-2.2/input0", {fader: 0})
+    state = midify.create_state(5000000)
+    sink = MidiSink(keep=True)
+    leds = LedFramebuffer(NullLedBackend())
+    unit = midify.create_unit(device, "1", leds, sink, state)
+    plugged_in = []
+
+    def find(ignore_paths, ignore_cards):
+        return [[device, "1"] for device in plugged_in if device.path not in ignore_paths], []
+
+    with tempfile.TemporaryDirectory() as input_dir:
+        supervisor = midify.ControllerSupervisor(
+            [unit], path=input_dir, find=find, open_backend=lambda card, name: NullLedBackend(card)
+        )
+        frames = midify.read_unit_frames([unit], lambda: 0.01, supervisor)
+
+        def run_until(done, limit=2):
+            deadline = time.monotonic() + limit
+
+            while not done() and time.monotonic() < deadline:
+                _, frame = next(frames)
+
+                for event in frame:
+                    midify.process_event(event, state, sink)
+
+        # Mixxx lights deck A's play LED
+        play_cc = midify.DISPATCH_TABLE[PLAY_A_EVCODE << 4][1]
+        midify.handle_midi_input(([0xB0, play_cc, 0x7F], 0), unit)
+        leds.flush()
+
+        device.push(
+            [
+                evdev.InputEvent(0, 0, evdev.ecodes.EV_KEY, SHIFT_A_EVCODE, 1),
+                evdev.InputEvent(0, 0, evdev.ecodes.EV_KEY, PLAY_A_EVCODE, 1),
+                evdev.InputEvent(0, 0, evdev.ecodes.EV_SYN, 0, 0),
+            ]
+        )
+        run_until(lambda: state["modifiers"] & midify.SHIFT_A)
+        device.unplug()
+        run_until(lambda: unit["device"] is None)
+        assert unit["device"] is None, "Unplugged controller wasn't detached"
+        assert not state["modifiers"] & midify.SHIFT_A, "Shift is still held after unplugging"
+        # Play was pressed with shift held, so it has to be released on its shifted CC
+        status, shifted_cc = midify.DISPATCH_TABLE[PLAY_A_EVCODE << 4 | midify.SHIFT_A][:2]
+        assert sink.sent[-1] == [status, shifted_cc, 0], f"Held button wasn't released after unplugging: {sink.sent}"
+
+        replugged = StandInDevice("/dev/input/event7", device.phys, {fader: 4095})
+        plugged_in.append(replugged)
+        sent = len(sink.sent)
+        start = time.monotonic()
+        open(os.path.join(input_dir, "event7"), "w").close()
+        run_until(lambda: unit["device"] is not None)
+        elapsed = time.monotonic() - start
+        supervisor.close()
+
+    device.close()
+    replugged.close()
+
+    assert unit["device"] is replugged, "Replugged controller wasn't reattached"
+    assert elapsed < 1, f"Reattaching took {elapsed:.2f}s"
+    assert [message[1] for message in sink.sent[sent:]] == [midify.DISPATCH_TABLE[fader << 4][1]], sink.sent[sent:]
+    assert leds.backend.writes > 0 and list(leds.written) == list(leds.desired), "LEDs weren't written again"
@@ -0,0 +1,31 @@
+import argparse
+
+import evdev
+import pytest
+
+from traktor_s4_mk1_midify import midify
+from traktor_s4_mk1_midify.bench import FADER_EVCODES, timestamped_event
+from traktor_s4_mk1_midify.recording import MidiSink
+
+
+# However much hysteresis a pot has, sweeping a fader all the way should still fully close and open its channel.
+@pytest.mark.parametrize("hysteresis", [16, 31, 40])
+def test_fader_sweep_reaches_both_ends(hysteresis):
+    state = midify.create_state(5000000, pot_hysteresis=hysteresis)
+    sink = MidiSink(keep=True)
+    positions = [*range(0, 4096, 7), 4095, *range(4095, -1, -7), 0]
+
+    for i, position in enumerate(positions):
+        midify.process_event(timestamped_event(i, 1000, evdev.ecodes.EV_ABS, FADER_EVCODES[0], position), state, sink)
+
+    values = [value for _, _, value in sink.sent]
+
+    assert 127 in values, "The fader was never sent fully open"
+    assert values[-1] == 0, f"The fader was left at {values[-1]}"
+
+
+def test_pot_hysteresis_option():
+    assert midify.pot_hysteresis("31") == 31
+
+    with pytest.raises(argparse.ArgumentTypeError):
+        midify.pot_hysteresis("32")
@@ -0,0 +1,117 @@
+import threading
+import time
+
+import pytest
+
+from traktor_s4_mk1_midify import midify
+from traktor_s4_mk1_midify.leds import BURST_SIZE, LedFramebuffer, NullLedBackend
+
+
+# Mixxx sends the state of every LED when it starts or reloads its mapping. Without a LED renderer, that burst should be
+# written in a few batches rather than one write per LED, and be on the controller within milliseconds.
+def test_full_refresh_is_batched():
+    backend = NullLedBackend()
+    leds = LedFramebuffer(backend)
+    unit = {"leds": leds, "deck_leds": None, "debug": False, "log": None}
+    messages = []
+
+    for cc, controls in enumerate(midify.MIDI_ALSA_CONTROL_MAP):
+        for channel in range(len(controls or [])):
+            message = [0xB0 | channel, cc, 0x7F]
+
+            if isinstance(midify.midi_to_alsa_control(message), int):
+                messages.append((message, 0))
+
+    start = time.perf_counter()
+
+    for message in messages:
+        midify.handle_midi_input(message, unit)
+
+    while leds.burst_timer is not None and time.perf_counter() - start < 1:
+        time.sleep(0.0005)
+
+    elapsed = time.perf_counter() - start
+    lit = {midify.midi_to_alsa_control(message) for message, _ in messages}
+
+    assert all(leds.written[alsa_id] == 31 for alsa_id in lit), "Not every LED was written"
+    assert backend.batches <= BURST_SIZE + 4, f"LEDs were written in {backend.batches} batches"
+    assert elapsed < 0.1, f"Writing the LEDs took {elapsed:.3f}s"
+
+
+class UnpluggedLedBackend(NullLedBackend):
+    def write(self, leds):
+        raise OSError(19, "No such device")
+
+
+# LEDs that couldn't be written (e.g. the controller was unplugged) shouldn't be taken as written, and should reach the
+# controller on the next flush once writes work again.
+def test_failed_write_is_retried():
+    leds = LedFramebuffer(UnpluggedLedBackend())
+    leds.deferred = True
+    leds.set([(3, 31), (4, 0)])
+
+    with pytest.raises(OSError):
+        leds.flush()
+
+    assert leds.written[3] == -1 and leds.written[4] == -1
+
+    backend = NullLedBackend()
+    leds.backend = backend
+    leds.flush()
+
+    assert backend.writes == 2
+    assert leds.written[3] == 31 and leds.written[4] == 0
+
+
+class RecordingLedBackend(NullLedBackend):
+    """Keeps the values written to it, like the controller would."""
+
+    def __init__(self):
+        super().__init__()
+        self.values = {}
+
+    def write(self, leds):
+        for alsa_id, brightness in leds:
+            self.values[alsa_id] = brightness
+
+
+class PausingLock:
+    """A lock that holds up one thread for a moment after it first releases it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.paused = threading.Event()
+
+    def __enter__(self):
+        self.lock.acquire()
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+        if threading.current_thread() is self.thread and not self.paused.is_set():
+            self.paused.set()
+            time.sleep(0.05)
+
+
+# An LED set again while another thread is between taking its old value and writing it should end up with the new
+# value, on the controller as well as in the framebuffer.
+def test_concurrent_flushes_keep_order():
+    backend = RecordingLedBackend()
+    leds = LedFramebuffer(backend)
+    leds.deferred = True
+    leds.set([(3, 31)])
+    leds.lock = lock = PausingLock()
+
+    def flush():
+        lock.thread = threading.current_thread()
+        leds.flush()
+
+    flusher = threading.Thread(target=flush)
+    flusher.start()
+    lock.paused.wait(1)
+    leds.set([(3, 0)])
+    leds.flush()
+    flusher.join()
+
+    assert backend.values[3] == leds.written[3] == 0
@@ -0,0 +1,27 @@
+import os
+import shutil
+
+import pytest
+
+from traktor_s4_mk1_midify import midify
+
+
+# A copy of the packaged mappings with one line of the event code type map replaced.
+def mapping_dir_with_type(tmp_path, evcode, control_type):
+    for filename in midify.MAPPING_FILENAMES:
+        shutil.copy(os.path.join(midify.MAPPING_DIR, filename), tmp_path / filename)
+
+    type_map = tmp_path / "evcode-type-map.csv"
+    lines = [line for line in type_map.read_text().splitlines() if not line.startswith(f"{evcode},")]
+    type_map.write_text("\n".join(lines + [f"{evcode},{control_type}"]) + "\n")
+    return tmp_path
+
+
+@pytest.mark.parametrize("evcode, control_type", [[54, "ROT"], [63, "ROT"], [58, "GAIN_ROT"], [54, "JOG_ROT"]])
+def test_encoder_types_are_only_allowed_on_their_controls(tmp_path, evcode, control_type):
+    tables = midify.DISPATCH_TABLE
+
+    with pytest.raises(ValueError):
+        midify.load_mappings(mapping_dir_with_type(tmp_path, evcode, control_type))
+
+    assert midify.DISPATCH_TABLE is tables
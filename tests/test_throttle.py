@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+
+import evdev
+
+from traktor_s4_mk1_midify import midify
+from traktor_s4_mk1_midify.bench import jog_scratch_workload
+from traktor_s4_mk1_midify.recording import MidiSink
+
+
+class RecordedDevice:
+    """Stands in for a controller's evdev, returning all of a recording's events from its first read."""
+
+    def __init__(self, events):
+        self.events = events
+
+    async def async_read(self):
+        if not self.events:
+            await asyncio.Event().wait()
+
+        events, self.events = self.events, []
+        return iter(events)
+
+
+class StandInInport:
+    def set_callback(self, callback, data):
+        pass
+
+    def cancel_callback(self):
+        pass
+
+
+# Each event in its own frame, as the controller sends them
+def with_syn_reports(events):
+    syn_report = [evdev.ecodes.EV_SYN, evdev.ecodes.SYN_REPORT, 0]
+    return [report for event in events for report in [event, evdev.InputEvent(event.sec, event.usec, *syn_report)]]
+
+
+# Encoders are throttled on the controller's event timestamps, so translating events live (however long they took to
+# be read) should give the same messages as replaying a recording of them.
+def test_live_input_matches_replay():
+    events = jog_scratch_workload(5000)
+    replay_state = midify.create_state(5000000)
+    replayed = MidiSink(keep=True)
+
+    for frame in midify.EventFrameCoalescer().feed(with_syn_reports(events)):
+        midify.process_frame(frame, replay_state, replayed)
+
+    midify.flush_encoders(replay_state, replayed)
+
+    state = midify.create_state(5000000)
+    sink = MidiSink(keep=True)
+    device = RecordedDevice(with_syn_reports(events))
+    unit = {
+        "device": device,
+        "inport": StandInInport(),
+        "outport": sink,
+        "state": state,
+        "coalescer": midify.EventFrameCoalescer(),
+        "log": None,
+    }
+
+    async def run_live():
+        task = asyncio.create_task(midify.midify_unit_async(unit, argparse.Namespace(led_fps=0)))
+
+        while device.events or state["pending_encoders"]:
+            await asyncio.sleep(0.001)
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run_live())
+
+    assert len(replayed.sent) > 100
+    assert sink.sent == replayed.sent
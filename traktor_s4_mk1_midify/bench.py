@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+
+# Micro-benchmarks for the hot paths in midify.py. These don't need a controller or Mixxx to be attached.
+
+import argparse
+import evdev
+import itertools
+import json
+import math
+import os
+import rtmidi
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from traktor_s4_mk1_midify import midify
+from traktor_s4_mk1_midify.leds import LedFramebuffer, NullLedBackend
+from traktor_s4_mk1_midify.recording import MidiSink
+
+# Channel volume faders for decks A-D
+FADER_EVCODES = [18, 17, 19, 16]
+JOG_EVCODES = [52, 53]
+VU_METER_CC = 0x46
+
+
+# A repeating stream of events covering every mapped control, with values that change on every event so that nothing
+# gets skipped as a duplicate.
+def synthetic_events(count):
+    codes = [code for code, control_type in enumerate(midify.EVCODE_TYPE_MAP) if control_type is not None]
+    events = []
+
+    for i, code in zip(range(count), itertools.cycle(codes)):
+        event_type = evdev.ecodes.EV_KEY if code >= 256 else evdev.ecodes.EV_ABS
+        events.append(evdev.InputEvent(i // 1000, i % 1000 * 1000, event_type, code, i % 1024))
+
+    return events
+
+
+# Looks up the translator by control type for each event, as midify did before DISPATCH_TABLE.
+def translate_with_evcode_to_midi(events, controller_data, shift_a, shift_b, toggle_ac, toggle_bd):
+    translators = midify.TRANSLATORS
+    translator_indicies = midify.TRANSLATOR_INDICIES
+    encoders = dict(zip(midify.ENCODER_NAMES, controller_data))
+
+    for event in events:
+        midi = midify.evcode_to_midi(event.code, shift_a, shift_b, toggle_ac, toggle_bd)
+
+        if midi is None:
+            continue
+
+        control_type = midify.EVCODE_TYPE_MAP[event.code]
+        encoder = None
+
+        match control_type:
+            case "JOG_ROT":
+                if event.code == 52:
+                    encoder = encoders["jog_c" if toggle_ac else "jog_a"]
+                else:
+                    encoder = encoders["jog_d" if toggle_bd else "jog_b"]
+            case "BROWSE_ROT":
+                encoder = encoders["browse_rot"]
+            case "ROT":
+                name = ["move_rot_", "size_rot_", "move_rot_", "size_rot_"][event.code - 55]
+
+                if event.code <= 56:
+                    encoder = encoders[name + ("c" if toggle_ac else "a")]
+                else:
+                    encoder = encoders[name + ("d" if toggle_bd else "b")]
+            case "GAIN_ROT":
+                encoder = encoders["gain_rot_" + "abcd"[event.code - 59]]
+
+        translators[translator_indicies[control_type]](event, encoder, midi[1], midi[0])
+
+
+def translate_with_dispatch_table(events, controller_data, modifiers):
+    dispatch_table = midify.DISPATCH_TABLE
+    translators = midify.TRANSLATORS
+
+    for event in events:
+        dispatch = dispatch_table[event.code << 4 | modifiers]
+
+        if dispatch is None:
+            continue
+
+        status, cc, translator, encoder = dispatch
+        translators[translator](event, None if encoder is None else controller_data[encoder], status, cc)
+
+
+def bench_translation(count):
+    events = synthetic_events(count)
+
+    start = time.perf_counter()
+    translate_with_evcode_to_midi(events, midify.create_controller_data(5000000, []), False, False, True, False)
+    before = count / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    translate_with_dispatch_table(events, midify.create_controller_data(5000000, []), midify.TOGGLE_AC)
+    after = count / (time.perf_counter() - start)
+
+    print("evcode -> MIDI translation ({} events)".format(count))
+    print("  evcode_to_midi + TRANSLATOR_INDICIES: {:>12,.0f} events/s".format(before))
+    print("  DISPATCH_TABLE + TRANSLATORS:         {:>12,.0f} events/s".format(after))
+    print("  Speedup: {:.2f}x".format(after / before))
+
+
+def timestamped_event(i, rate, event_type, code, value):
+    usec = i * 1000000 // rate
+    return evdev.InputEvent(usec // 1000000, usec % 1000000, event_type, code, value)
+
+
+# Both jog wheels being scratched back and forth, each reporting at 1 kHz.
+def jog_scratch_workload(count):
+    events = []
+
+    for i in range(count // 2):
+        position = int(512 + 511 * math.sin(i / 50))
+
+        for code in JOG_EVCODES:
+            events.append(timestamped_event(i, 1000, evdev.ecodes.EV_ABS, code, position))
+
+    return events
+
+
+# All four channel faders being swept from bottom to top and back again.
+def fader_sweep_workload(count):
+    events = []
+
+    for i in range(count // 4):
+        position = abs(i % 8190 - 4095)
+
+        for code in FADER_EVCODES:
+            events.append(timestamped_event(i, 1000, evdev.ecodes.EV_ABS, code, position))
+
+    return events
+
+
+# VU meter messages for two channels, as Mixxx sends them when playing a stereo track.
+def vu_meter_workload(count):
+    messages = []
+
+    for i in range(count // 2):
+        level = int(64 + 63 * math.sin(i / 10))
+        messages.append(([0xB0, VU_METER_CC, level], 0))
+        messages.append(([0xB1, VU_METER_CC, max(0, level - 3)], 0))
+
+    return messages
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[int(fraction * (len(sorted_values) - 1))]
+
+
+# Call handler once per item, returning throughput and per-item latency percentiles in nanoseconds.
+def measure(handler, items):
+    latencies = []
+    clock = time.perf_counter_ns
+    start = clock()
+
+    for item in items:
+        before = clock()
+        handler(item)
+        latencies.append(clock() - before)
+
+    elapsed = clock() - start
+    latencies.sort()
+
+    return {
+        "throughput": len(items) / elapsed * 1e9,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "p999": percentile(latencies, 0.999),
+    }
+
+
+def run_workloads(count):
+    results = {}
+
+    for name, workload in [("jog_scratch", jog_scratch_workload), ("fader_sweep", fader_sweep_workload)]:
+        state = midify.create_state(5000000)
+        sink = MidiSink()
+
+        def handler(event, state=state, sink=sink):
+            midify.process_event(event, state, sink)
+            midify.flush_encoders(state, sink, midify.event_time_ns(event))
+
+        results[name] = measure(handler, workload(count))
+
+    # Each message is flushed to the backend straight after it's handled, so that the whole MIDI to LED path is timed.
+    # Left to itself, the framebuffer would treat the workload as a burst and batch the writes on a timer thread.
+    leds = LedFramebuffer(NullLedBackend())
+    leds.deferred = True
+    unit = {"leds": leds, "deck_leds": None, "debug": False, "log": None}
+    messages = vu_meter_workload(count)
+
+    def handle_message(message):
+        midify.handle_midi_input(message, unit)
+        leds.flush()
+
+    results["vu_meter"] = measure(handle_message, messages)
+    controls = midify.MIDI_ALSA_CONTROL_MAP[VU_METER_CC][0]
+
+    def set_vu_meter(message):
+        midify.set_vu_meter(leds, controls, message[0][2])
+        leds.flush()
+
+    results["set_vu_meter"] = measure(set_vu_meter, messages)
+
+    return results
+
+
+def print_results(results, baseline=None):
+    print("{:<14}{:>16}{:>12}{:>12}{:>12}".format("Workload", "Events/s", "p50 (ns)", "p99 (ns)", "p999 (ns)"))
+
+    for name, result in results.items():
+        line = "{:<14}{:>16,.0f}{:>12,}{:>12,}{:>12,}".format(name, *result.values())
+
+        if baseline and name in baseline:
+            change = (result["throughput"] / baseline[name]["throughput"] - 1) * 100
+            line += "  ({:+.1f}% throughput vs. baseline)".format(change)
+
+        print(line)
+
+
+# Time how long a fresh interpreter takes to import midify and load its mappings, with an empty mapping cache (cold) and
+# with the cache from the previous run (warm).
+def bench_startup(runs):
+    command = [sys.executable, "-c", "from traktor_s4_mk1_midify import midify; midify.load_mappings()"]
+    baseline_command = [sys.executable, "-c", "pass"]
+    results = {}
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, XDG_CACHE_HOME=cache_dir)
+
+        for name in ["cold", "warm"]:
+            timings = []
+
+            for _ in range(runs):
+                if name == "cold":
+                    shutil.rmtree(os.path.join(cache_dir, "traktor-s4-mk1-midify"), ignore_errors=True)
+
+                start = time.perf_counter_ns()
+                subprocess.run(command, env=env, check=True)
+                timings.append(time.perf_counter_ns() - start)
+
+            results[name] = sorted(timings)
+
+    start = time.perf_counter_ns()
+
+    for _ in range(runs):
+        subprocess.run(baseline_command, check=True)
+
+    interpreter = (time.perf_counter_ns() - start) / runs
+
+    start = time.perf_counter_ns()
+    midify.compile_mappings(midify.MAPPING_DIR)
+    compile_time = time.perf_counter_ns() - start
+
+    start = time.perf_counter_ns()
+    midify.load_mappings()
+    load_time = time.perf_counter_ns() - start
+
+    print("Startup ({} runs, median)".format(runs))
+    print("  Python interpreter alone:        {:>8.1f}ms".format(interpreter / 1e6))
+
+    for name, timings in results.items():
+        print("  Import + load_mappings ({}): {:>8.1f}ms".format(name, percentile(timings, 0.5) / 1e6))
+
+    print("  compile_mappings in-process:     {:>8.2f}ms".format(compile_time / 1e6))
+    print("  load_mappings from cache:        {:>8.2f}ms".format(load_time / 1e6))
+
+
+# Index of the first port with a name containing port_name.
+def find_midi_port(midi, port_name):
+    for index, name in enumerate(midi.get_ports()):
+        if port_name in name:
+            return index
+
+    raise ValueError(f"Couldn't find MIDI port {port_name}")
+
+
+# Round trip time of MIDI messages through an rtmidi backend. Messages are sent from a virtual output port like
+# midify's, echoed back by a stand-in client (in place of Mixxx) connected to it, and received on a virtual input port
+# like midify's, so the time covers both directions that messages travel between midify and Mixxx.
+def bench_midi_latency(api_name, count, timeout=1):
+    api = midify.MIDI_APIS[api_name]
+    port_name = f"{midify.MIDI_PORT_NAME}-latency"
+    midiout = rtmidi.MidiOut(api, name="blaxpot")
+    midiin = rtmidi.MidiIn(api, name="blaxpot")
+    client_in = rtmidi.MidiIn(api, name="stand-in")
+    client_out = rtmidi.MidiOut(api, name="stand-in")
+    outport = midiout.open_virtual_port(name=port_name)
+    inport = midiin.open_virtual_port(name=port_name)
+    client_in.open_port(find_midi_port(client_in, port_name))
+    client_out.open_port(find_midi_port(client_out, port_name))
+    client_in.set_callback(lambda msg, data: client_out.send_message(msg[0]))
+
+    received = threading.Event()
+    expected = [None]
+    arrived = [0]
+
+    def echoed(msg, data):
+        if msg[0][2] == expected[0]:
+            arrived[0] = time.perf_counter_ns()
+            received.set()
+
+    inport.set_callback(echoed)
+    latencies = []
+    lost = 0
+
+    try:
+        for i in range(count):
+            expected[0] = i & 0x7F
+            received.clear()
+            start = time.perf_counter_ns()
+            outport.send_message([0xB0, 0x7F, i & 0x7F])
+
+            if received.wait(timeout):
+                latencies.append(arrived[0] - start)
+            else:
+                lost += 1
+    finally:
+        for midi in [client_in, client_out, inport, outport]:
+            midi.close_port()
+
+        for midi in [client_in, client_out, midiin, midiout]:
+            midi.delete()
+
+    latencies.sort()
+
+    return {
+        "p50": percentile(latencies, 0.5) if latencies else 0,
+        "p99": percentile(latencies, 0.99) if latencies else 0,
+        "p999": percentile(latencies, 0.999) if latencies else 0,
+        "max": latencies[-1] if latencies else 0,
+        "lost": lost,
+    }
+
+
+def print_midi_latency(api_names, count):
+    print("MIDI round trip latency ({} messages)".format(count))
+    print(
+        "{:<8}{:>12}{:>12}{:>12}{:>12}{:>8}".format("Backend", "p50 (us)", "p99 (us)", "p999 (us)", "max (us)", "Lost")
+    )
+
+    for api_name in api_names:
+        if midify.MIDI_APIS[api_name] not in rtmidi.get_compiled_api():
+            print("{:<8}python-rtmidi was built without {} support".format(api_name, api_name))
+            continue
+
+        try:
+            result = bench_midi_latency(api_name, count)
+        except (rtmidi.RtMidiError, ValueError) as error:
+            print("{:<8}Couldn't open ports ({})".format(api_name, error))
+            continue
+
+        print(
+            "{:<8}{:>12,.1f}{:>12,.1f}{:>12,.1f}{:>12,.1f}{:>8}".format(
+                api_name, *(result[key] / 1000 for key in ["p50", "p99", "p999", "max"]), result["lost"]
+            )
+        )
+
+
+def bench():
+    parser = argparse.ArgumentParser(description="Benchmark traktor-s4-mk1-midify without a controller attached")
+    parser.add_argument("-n", "--events", type=int, default=200000, help="Number of events per workload")
+    parser.add_argument("-s", "--save", metavar="FILENAME", help="Save the results as a baseline to compare against")
+    parser.add_argument("-c", "--compare", metavar="FILENAME", help="Compare the results against a saved baseline")
+    parser.add_argument("--startup_runs", type=int, default=10, help="Number of runs for the startup benchmark")
+
+    parser.add_argument(
+        "--midi_latency",
+        nargs="+",
+        choices=midify.MIDI_APIS,
+        help="Only measure MIDI round trip latency through these rtmidi backends, e.g. alsa jack",
+    )
+
+    parser.add_argument(
+        "--midi_messages",
+        type=int,
+        default=1000,
+        help="Number of messages for the MIDI latency measurement (default: 1000)",
+    )
+
+    args = parser.parse_args()
+
+    if args.midi_latency:
+        print_midi_latency(args.midi_latency, args.midi_messages)
+        return
+
+    midify.load_mappings()
+    bench_translation(args.events)
+    print()
+
+    results = run_workloads(args.events)
+    baseline = None
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+
+    print()
+    bench_startup(args.startup_runs)
+
+
+if __name__ == "__main__":
+    bench()
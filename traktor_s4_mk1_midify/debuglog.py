@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# Debug logging that stays off the hot path. The event loop and MIDI callback only append a tuple of raw values to a
+# bounded buffer; a background thread formats them and writes them out. If the writer can't keep up, records are
+# dropped and counted rather than making the event loop wait.
+#
+# Logs can be written as text, or as a binary file of fixed size records (see DEBUG_LOG_RECORD) which is much cheaper to
+# write, and can be printed later with traktor-s4-mk1-debug-log.
+
+import argparse
+import collections
+import struct
+import sys
+import threading
+import time
+
+LOG_EVENT = 0
+LOG_SENT = 1
+LOG_RECEIVED = 2
+
+DEBUG_LOG_MAGIC = b"TS4MK1DL"
+DEBUG_LOG_VERSION = 1
+DEBUG_LOG_HEADER = struct.Struct("<8sI4x")
+
+# Kind, event code, MIDI status, MIDI CC, value, monotonic timestamp in nanoseconds. Fields that don't apply to a kind
+# of record are -1, e.g. the MIDI status and CC of a controller event.
+DEBUG_LOG_RECORD = struct.Struct("<Bxhhhiq")
+
+
+def format_debug_record(kind, evcode, status, cc, value, timestamp_ns):
+    timestamp = timestamp_ns / 1e9
+
+    if kind == LOG_EVENT:
+        return f"[{timestamp:.6f}] [Processing event] Code: {evcode}, Value: {value}"
+
+    if kind == LOG_SENT:
+        return "[{:.6f}] [Sent MIDI message] Channel: {}, CC: {}, Value: {} (event code {})".format(
+            timestamp, hex(status), hex(cc), hex(value), evcode
+        )
+
+    return "[{:.6f}] [Recieved MIDI message] Channel: {}, CC: {}, Value: {}".format(
+        timestamp, hex(status), hex(cc), hex(value)
+    )
+
+
+class DebugLog(threading.Thread):
+    """
+    Collect debug records in a bounded buffer and write them from a background thread.
+
+    log() may be called from any thread. collections.deque's append() and popleft() are atomic, so neither side ever
+    takes a lock. Only records matching the event code / MIDI CC filters (if given) are kept. The event code filter
+    applies to controller events and sent MIDI messages, and the MIDI CC filter to sent and received MIDI messages.
+    """
+
+    def __init__(self, file=None, binary=False, evcodes=None, ccs=None, size=65536, interval=0.05):
+        super().__init__(name="debug-log", daemon=True)
+        self.records = collections.deque()
+        self.size = size
+        self.evcodes = evcodes
+        self.ccs = ccs
+        self.binary = binary
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.overflows = 0
+        self.reported_overflows = 0
+
+        if file is None:
+            self.file = sys.stdout.buffer if binary else sys.stdout
+            self.close_file = False
+        else:
+            self.file = open(file, "wb" if binary else "w")
+            self.close_file = True
+
+        if binary:
+            self.file.write(DEBUG_LOG_HEADER.pack(DEBUG_LOG_MAGIC, DEBUG_LOG_VERSION))
+
+    def log(self, kind, evcode, status, cc, value):
+        if self.evcodes is not None and kind != LOG_RECEIVED and evcode not in self.evcodes:
+            return
+
+        if self.ccs is not None and kind != LOG_EVENT and cc not in self.ccs:
+            return
+
+        if len(self.records) >= self.size:
+            self.overflows += 1
+            return
+
+        self.records.append((kind, evcode, status, cc, value, time.monotonic_ns()))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.drain()
+
+    def drain(self):
+        records = self.records
+
+        while records:
+            record = records.popleft()
+
+            if self.binary:
+                self.file.write(DEBUG_LOG_RECORD.pack(*record))
+            else:
+                self.file.write(format_debug_record(*record) + "\n")
+
+        if self.overflows != self.reported_overflows:
+            print(f"[Debug log] Dropped {self.overflows - self.reported_overflows} records", file=sys.stderr)
+            self.reported_overflows = self.overflows
+
+        self.file.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.drain()
+
+        if self.close_file:
+            self.file.close()
+
+
+def read_debug_log(filename):
+    with open(filename, "rb") as debug_log:
+        data = debug_log.read()
+
+    magic, version = DEBUG_LOG_HEADER.unpack_from(data)
+
+    if magic != DEBUG_LOG_MAGIC or version != DEBUG_LOG_VERSION:
+        raise ValueError(f"{filename} isn't a traktor-s4-mk1-midify debug log")
+
+    # Ignore a partially written record at the end, e.g. if midify was killed
+    start = DEBUG_LOG_HEADER.size
+    end = len(data) - (len(data) - start) % DEBUG_LOG_RECORD.size
+
+    yield from DEBUG_LOG_RECORD.iter_unpack(memoryview(data)[start:end])
+
+
+def print_debug_log():
+    parser = argparse.ArgumentParser(description="Print a binary debug log written by traktor-s4-mk1-midify")
+    parser.add_argument("filename", help="File written with --debug_file and --debug_binary")
+    args = parser.parse_args()
+
+    for record in read_debug_log(args.filename):
+        print(format_debug_record(*record))
+
+
+if __name__ == "__main__":
+    print_debug_log()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+# Print the events sent by the controller (live, or from a recording made with traktor-s4-mk1-record), or with --stats,
+# profile them: how often each control sends events, how far apart they arrive, how many change nothing, and how many
+# MIDI messages the current translation and throttling turns them into. Encoder throttle windows are simulated over the
+# event timestamps to recommend a window for each control.
+
+import argparse
+import array
+import collections
+import evdev
+
+from traktor_s4_mk1_midify import midify
+from traktor_s4_mk1_midify.recording import MidiSink, read_recording
+from traktor_s4_mk1_midify.stats import Stats
+
+# Control types whose MIDI messages are rate limited by an Encoder (see flush_encoders)
+THROTTLED_TYPES = ["JOG_ROT", "ROT", "BROWSE_ROT", "GAIN_ROT"]
+
+# Throttle windows to simulate, in milliseconds
+THROTTLE_WINDOWS_MS = [1, 2, 3, 5, 8, 10, 15, 20, 30, 50]
+
+# The recommended window for a control is the smallest that keeps its busiest PEAK_RATE_WINDOW_NS of messages below
+# this many per second, which is about as fast as Mixxx can usefully redraw for a single control.
+TARGET_MESSAGE_RATE = 250
+PEAK_RATE_WINDOW_NS = 100000000
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[int(fraction * (len(sorted_values) - 1))]
+
+
+# Times MIDI messages would be sent for events at the given times, with an encoder's throttling: the first movement is
+# sent straight away, and movement during the window is sent together once the window is up.
+def throttled_send_times(times, window_ns):
+    sent = []
+    last_sent = None
+    pending = False
+
+    for time_ns in times:
+        if pending and time_ns >= last_sent + window_ns:
+            last_sent += window_ns
+            sent.append(last_sent)
+            pending = False
+
+        if last_sent is None or time_ns >= last_sent + window_ns:
+            last_sent = time_ns
+            sent.append(last_sent)
+        else:
+            pending = True
+
+    if pending:
+        sent.append(last_sent + window_ns)
+
+    return sent
+
+
+# Messages per second in the busiest PEAK_RATE_WINDOW_NS.
+def peak_rate(times):
+    buckets = collections.Counter(time_ns // PEAK_RATE_WINDOW_NS for time_ns in times)
+    return max(buckets.values(), default=0) * 1000000000 / PEAK_RATE_WINDOW_NS
+
+
+def recommend_window_ms(times):
+    for window_ms in THROTTLE_WINDOWS_MS:
+        if peak_rate(throttled_send_times(times, window_ms * 1000000)) <= TARGET_MESSAGE_RATE:
+            return window_ms
+
+    return THROTTLE_WINDOWS_MS[-1]
+
+
+class EventProfile:
+    """
+    Collect per event code statistics for a stream of controller events, translating them to MIDI (into a MidiSink)
+    with the given settings to count the messages they would produce.
+    """
+
+    def __init__(self, jog_sensitivity=5000000, jog_acceleration=0, pot_hysteresis=0):
+        self.jog_sensitivity = jog_sensitivity
+        self.stats = Stats()
+        self.state = midify.create_state(jog_sensitivity, self.stats, jog_acceleration, pot_hysteresis=pot_hysteresis)
+        self.sink = MidiSink()
+        self.coalescer = midify.EventFrameCoalescer()
+        self.control_values = [None for _ in range(350)]
+        self.times = [array.array("q") for _ in range(350)]  # Timestamps of every event, per event code
+        self.changes = [array.array("q") for _ in range(350)]  # Timestamps of events that changed the value
+        self.first_event_ns = None
+        self.last_event_ns = None
+
+    def add(self, event):
+        if event.type in (evdev.ecodes.EV_KEY, evdev.ecodes.EV_ABS):
+            event_ns = midify.event_time_ns(event)
+
+            if self.first_event_ns is None:
+                self.first_event_ns = event_ns
+
+            self.last_event_ns = event_ns
+            self.times[event.code].append(event_ns)
+
+            if event.value != self.control_values[event.code]:
+                self.control_values[event.code] = event.value
+                self.changes[event.code].append(event_ns)
+
+        for frame in self.coalescer.feed([event]):
+            midify.process_frame(frame, self.state, self.sink)
+
+    def current_window_ms(self, control_type):
+        if control_type == "JOG_ROT":
+            return self.jog_sensitivity / 1000000
+
+        return midify.ROT_THROTTLE_NS / 1000000
+
+    def format_report(self):
+        midify.flush_encoders(self.state, self.sink)
+
+        if self.first_event_ns is None:
+            return ["No controller events"]
+
+        duration = max(self.last_event_ns - self.first_event_ns, 1) / 1e9
+        lines = [
+            "{:>6} {:<11}{:>9}{:>10}{:>9}{:>9}{:>9}{:>7}{:>9}{:>10}{:>7}".format(
+                "Code", "Type", "Events", "Events/s", "p50 ms", "p90 ms", "p99 ms", "Dup %", "MIDI", "Window ms", "Rec."
+            )
+        ]
+        by_type = collections.defaultdict(lambda: [0, 0, 0])
+        recommendations = {}
+
+        for evcode, times in enumerate(self.times):
+            if not times:
+                continue
+
+            control_type = midify.EVCODE_TYPE_MAP[evcode] if evcode < len(midify.EVCODE_TYPE_MAP) else None
+            gaps = sorted(later - earlier for earlier, later in zip(times, times[1:]))
+            duplicates = len(times) - len(self.changes[evcode])
+            messages = self.stats.messages[evcode]
+            current = recommended = "-"
+
+            if control_type in THROTTLED_TYPES:
+                current = f"{self.current_window_ms(control_type):g}"
+                recommended = recommend_window_ms(self.changes[evcode])
+                recommendations[evcode] = [control_type, current, recommended]
+
+            lines.append(
+                "{:>6} {:<11}{:>9}{:>10.1f}{:>9}{:>9}{:>9}{:>7.1f}{:>9}{:>10}{:>7}".format(
+                    evcode,
+                    control_type or "-",
+                    len(times),
+                    len(times) / duration,
+                    *(f"{percentile(gaps, fraction) / 1e6:.2f}" if gaps else "-" for fraction in [0.5, 0.9, 0.99]),
+                    duplicates / len(times) * 100,
+                    messages,
+                    current,
+                    recommended,
+                )
+            )
+
+            totals = by_type[control_type or "-"]
+            totals[0] += len(times)
+            totals[1] += duplicates
+            totals[2] += messages
+
+        lines.append("")
+        lines.append(f"Over {duration:.1f}s:")
+
+        for control_type, [events, duplicates, messages] in sorted(by_type.items()):
+            lines.append(
+                "  {:<11}{:>9} events ({:.1f}/s, {:.1f}% duplicates) -> {} MIDI messages".format(
+                    control_type, events, events / duration, duplicates / events * 100, messages
+                )
+            )
+
+        if recommendations:
+            lines.append("")
+            lines.append(f"Recommended throttle windows (keeping each control below {TARGET_MESSAGE_RATE} messages/s):")
+
+            for evcode, [control_type, current, recommended] in recommendations.items():
+                change = "keep" if float(current) == recommended else f"currently {current}ms"
+                lines.append(f"  Event code {evcode} ({control_type}): {recommended}ms ({change})")
+
+        return lines
+
+
+def print_events():
+    parser = argparse.ArgumentParser(description="Print the events sent by a Traktor S4 mk1, or profile them")
+    parser.add_argument(
+        "-t",
+        "--trace",
+        metavar="FILENAME",
+        help="Read events from a recording made with traktor-s4-mk1-record instead of the controller",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--stats",
+        action="store_true",
+        help="Print event rates, timing and simulated MIDI message counts per event code instead of the events",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jog_sensitivity",
+        type=int,
+        default=5,
+        help="Jog wheel sensitivity to simulate with --stats (min: 1, max: 100, default: 5)",
+    )
+
+    parser.add_argument(
+        "--jog_acceleration",
+        type=float,
+        default=0,
+        help="Jog wheel acceleration to simulate with --stats (default: 0)",
+    )
+
+    parser.add_argument(
+        "-p",
+        "--pot_hysteresis",
+        type=midify.pot_hysteresis,
+        default=0,
+        help="Pot hysteresis to simulate with --stats (max: 31, default: 0)",
+    )
+
+    args = parser.parse_args()
+    traktor_s4 = None
+
+    if args.trace:
+        events = read_recording(args.trace)
+    else:
+        traktor_s4 = midify.detect_controller_device()
+        events = traktor_s4.read_loop()
+
+    if args.stats:
+        midify.load_mappings()
+        profile = EventProfile(args.jog_sensitivity * 1000000, args.jog_acceleration, args.pot_hysteresis)
+
+        if traktor_s4 is not None:
+            print("Collecting events... (press Ctrl+C to stop)")
+
+    control_values = [None for _ in range(350)]
+
+    try:
+        for event in events:
+            if args.stats:
+                profile.add(event)
+                continue
+
+            if event.value == control_values[event.code]:
+                continue
+
+            control_values[event.code] = event.value
+            print(event)
+    except KeyboardInterrupt:
+        pass
+
+    if traktor_s4 is not None:
+        traktor_s4.close()
+
+    if args.stats:
+        print("\n".join(profile.format_report()))
+
+
+if __name__ == "__main__":
+    print_events()
@@ -0,0 +1,97 @@
+# Minimal inotify bindings (via ctypes, so there are no extra dependencies) for watching directories for changes.
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event from sys/inotify.h, followed by a null padded name of the length given in the last field
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+
+        return wd
+
+    # Returns [watch descriptor, mask, name] for each event available without blocking.
+    def read(self):
+        events = []
+
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return events
+
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            start = offset + INOTIFY_EVENT.size
+            offset = start + length
+            events.append([wd, mask, data[start:offset].rstrip(b"\0").decode(errors="replace")])
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class InotifyWatcher(threading.Thread):
+    """
+    Watch a directory and call callback with the set of names that changed in it. Changes are collected until none have
+    happened for `settle` seconds, so that an editor saving a file in several steps only causes one callback.
+    """
+
+    def __init__(self, path, mask, callback, settle=0.1):
+        super().__init__(name=f"inotify-watcher:{path}", daemon=True)
+        self.inotify = Inotify()
+        self.inotify.add_watch(path, mask)
+        self.callback = callback
+        self.settle = settle
+        self.stopped = threading.Event()
+
+    def run(self):
+        changed = set()
+        deadline = None
+
+        while not self.stopped.is_set():
+            timeout = 0.5 if deadline is None else max(0, deadline - time.monotonic())
+            readable, _, _ = select.select([self.inotify.fd], [], [], timeout)
+
+            if readable:
+                changed.update(name for _, _, name in self.inotify.read())
+                deadline = time.monotonic() + self.settle
+            elif deadline is not None and time.monotonic() >= deadline:
+                self.callback(changed)
+                changed = set()
+                deadline = None
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.inotify.close()
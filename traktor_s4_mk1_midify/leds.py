@@ -0,0 +1,393 @@
+# LED output backends. Each backend writes batches of (ALSA numid, brightness) pairs to the controller's ALSA control
+# interface. Opening the control interface once and writing to it directly is much cheaper than forking an amixer
+# process per LED change, which matters when Mixxx is sending dozens of VU meter updates per second.
+
+import array
+import asyncio
+import ctypes
+import ctypes.util
+import subprocess
+import threading
+import time
+
+
+class AlsaCtlLedBackend:
+    """Write LED values in-process through alsa-lib's control interface (snd_ctl_*) using ctypes."""
+
+    name = "ctl"
+
+    def __init__(self, card):
+        library = ctypes.util.find_library("asound")
+
+        if library is None:
+            raise OSError("Couldn't find alsa-lib (libasound)")
+
+        self.lib = ctypes.CDLL(library)
+        self.lib.snd_ctl_open.argtypes = [ctypes.POINTER(ctypes.c_void_p), ctypes.c_char_p, ctypes.c_int]
+        self.lib.snd_ctl_close.argtypes = [ctypes.c_void_p]
+        self.lib.snd_ctl_elem_value_malloc.argtypes = [ctypes.POINTER(ctypes.c_void_p)]
+        self.lib.snd_ctl_elem_value_free.argtypes = [ctypes.c_void_p]
+        self.lib.snd_ctl_elem_value_set_numid.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+        self.lib.snd_ctl_elem_value_set_integer.argtypes = [ctypes.c_void_p, ctypes.c_uint, ctypes.c_long]
+        self.lib.snd_ctl_elem_write.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        self.lib.snd_strerror.restype = ctypes.c_char_p
+
+        self.ctl = ctypes.c_void_p()
+        err = self.lib.snd_ctl_open(ctypes.byref(self.ctl), f"hw:{card}".encode(), 0)
+
+        if err < 0:
+            raise OSError(-err, self.lib.snd_strerror(err).decode())
+
+        self.value = ctypes.c_void_p()
+        err = self.lib.snd_ctl_elem_value_malloc(ctypes.byref(self.value))
+
+        if err < 0:
+            self.lib.snd_ctl_close(self.ctl)
+            raise OSError(-err, self.lib.snd_strerror(err).decode())
+
+    def write(self, leds):
+        for alsa_id, brightness in leds:
+            # The kernel looks controls up by numid when one is set, so the rest of the element ID can be left alone.
+            self.lib.snd_ctl_elem_value_set_numid(self.value, alsa_id)
+            self.lib.snd_ctl_elem_value_set_integer(self.value, 0, brightness)
+            err = self.lib.snd_ctl_elem_write(self.ctl, self.value)
+
+            if err < 0:
+                raise OSError(-err, self.lib.snd_strerror(err).decode())
+
+    def close(self):
+        self.lib.snd_ctl_elem_value_free(self.value)
+        self.lib.snd_ctl_close(self.ctl)
+
+
+class AmixerSessionLedBackend:
+    """Write LED values through a single long-lived `amixer -s` process, feeding it cset commands over stdin."""
+
+    name = "amixer"
+
+    def __init__(self, card):
+        self.process = subprocess.Popen(
+            ["amixer", "-c", card, "-q", "-s"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+
+    def write(self, leds):
+        self.process.stdin.write("".join(f"cset numid={alsa_id} {brightness}\n" for alsa_id, brightness in leds))
+        self.process.stdin.flush()
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class SubprocessLedBackend:
+    """Write LED values by running amixer once per batch. Slow, but has no requirements beyond alsa-utils."""
+
+    name = "subprocess"
+
+    def __init__(self, card):
+        self.card = card
+
+    def write(self, leds):
+        subprocess.run(
+            ["amixer", "-c", self.card, "-q", "-s"],
+            input="".join(f"cset numid={alsa_id} {brightness}\n" for alsa_id, brightness in leds),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+
+    def close(self):
+        pass
+
+
+class NullLedBackend:
+    """Discards LED values, counting them, e.g. while the controller is unplugged or when benchmarking."""
+
+    name = "null"
+
+    def __init__(self, card=None):
+        self.writes = 0
+        self.batches = 0
+
+    def write(self, leds):
+        self.batches += 1
+
+        for _ in leds:
+            self.writes += 1
+
+    def close(self):
+        pass
+
+
+LED_BACKENDS = {
+    AlsaCtlLedBackend.name: AlsaCtlLedBackend,
+    AmixerSessionLedBackend.name: AmixerSessionLedBackend,
+    SubprocessLedBackend.name: SubprocessLedBackend,
+}
+
+
+# With "auto", try each backend in order of preference and fall back to the next one if it can't be opened.
+def open_led_backend(card, name="auto"):
+    if name != "auto":
+        return LED_BACKENDS[name](card)
+
+    for backend in LED_BACKENDS.values():
+        try:
+            return backend(card)
+        except OSError as error:
+            print(f"Couldn't open {backend.name} LED backend ({error}), trying the next one.")
+
+
+# Without a renderer, LED changes arriving less than BURST_GAP seconds apart count as a burst, e.g. Mixxx sending the
+# state of every LED when it starts or reloads its mapping. After BURST_SIZE changes in a row, the rest of the burst is
+# collected and written in batches every BURST_GAP seconds instead of one write per change.
+BURST_GAP = 0.005
+BURST_SIZE = 8
+
+
+class LedFramebuffer:
+    """
+    Desired and last written brightness of each LED, indexed by ALSA numid. Only changes reach the backend.
+
+    Unless a LedRenderer is attached, set() writes through to the backend straight away, apart from during bursts (see
+    BURST_GAP). With a renderer, set() only updates the desired state and the renderer thread flushes it to the backend
+    once per frame, so an LED which is set several times between frames is only written once, with its newest value.
+    """
+
+    def __init__(self, backend, size=256):
+        self.backend = backend
+        # -1 means unknown, so the first write to each LED always goes out
+        self.desired = array.array("b", [-1 for _ in range(size)])
+        self.written = array.array("b", [-1 for _ in range(size)])
+        self.pending = bytearray(size)
+        self.received = [0 for _ in range(size)]
+        self.dirty = []
+        self.lock = threading.Lock()
+        # Held for the whole of a flush, so that the backend can't be swapped out (and closed) mid-write, and so that
+        # flushes from different threads reach the backend in the same order as they took the desired values
+        self.backend_lock = threading.Lock()
+        self.deferred = False
+        self.last_set = 0
+        self.burst = 0
+        self.burst_timer = None
+        self.writes = 0
+        self.suppressed = 0
+        self.coalesced = 0
+        self.stats = None  # See stats.py
+
+    def set(self, leds):
+        received = self.stats.clock() if self.stats is not None else 0
+
+        with self.lock:
+            for alsa_id, brightness in leds:
+                if self.pending[alsa_id]:
+                    self.coalesced += 1
+                else:
+                    self.pending[alsa_id] = 1
+                    self.received[alsa_id] = received
+                    self.dirty.append(alsa_id)
+
+                self.desired[alsa_id] = brightness
+
+            if self.deferred:
+                return
+
+            now = time.monotonic()
+            self.burst = self.burst + 1 if now - self.last_set < BURST_GAP else 0
+            self.last_set = now
+
+            if self.burst >= BURST_SIZE:
+                if self.burst_timer is None:
+                    self.start_burst_timer()
+
+                return
+
+        flush_frame(self)
+
+    def start_burst_timer(self):
+        self.burst_timer = threading.Timer(BURST_GAP, self.flush_burst)
+        self.burst_timer.daemon = True
+        self.burst_timer.start()
+
+    # Called BURST_GAP seconds into a burst, and every BURST_GAP seconds after that until it's over.
+    def flush_burst(self):
+        flush_frame(self)
+
+        with self.lock:
+            if self.burst >= BURST_SIZE and time.monotonic() - self.last_set < BURST_GAP:
+                self.start_burst_timer()
+            else:
+                self.burst = 0
+                self.burst_timer = None
+
+        # Anything set after the flush above, but before the burst was seen to be over
+        flush_frame(self)
+
+    # Flushes can come from the MIDI callback, the burst timer and the event loop (see DeckLeds) at once, so the backend
+    # lock is held from taking the dirty LEDs until they've been written. Otherwise an older value could be written
+    # after a newer one, leaving the LED wrong while `written` says it's right.
+    def flush(self):
+        with self.backend_lock:
+            changed = []
+
+            with self.lock:
+                dirty, self.dirty = self.dirty, []
+
+                for alsa_id in dirty:
+                    self.pending[alsa_id] = 0
+                    brightness = self.desired[alsa_id]
+
+                    if self.written[alsa_id] == brightness:
+                        self.suppressed += 1
+                        continue
+
+                    self.written[alsa_id] = brightness
+                    changed.append((alsa_id, brightness))
+
+            # Write outside the lock so that set() never waits on the hardware while a renderer is flushing.
+            if not changed:
+                return
+
+            try:
+                self.backend.write(changed)
+            except OSError:
+                self.retry(changed)
+                raise
+
+            self.writes += len(changed)
+
+        if self.stats is not None:
+            written = self.stats.clock()
+
+            for alsa_id, _ in changed:
+                self.stats.midi_to_led.record(written - self.received[alsa_id])
+
+    # Mark LEDs from a failed write as not written, and write them again on the next flush (unless they've been set to
+    # something else since).
+    def retry(self, leds):
+        with self.lock:
+            for alsa_id, brightness in leds:
+                if self.written[alsa_id] == brightness:
+                    self.written[alsa_id] = -1
+
+                if not self.pending[alsa_id]:
+                    self.pending[alsa_id] = 1
+                    self.dirty.append(alsa_id)
+
+    # Forget what has been written so that the next write to each LED reaches the hardware, e.g. after a reconnect.
+    def invalidate(self):
+        with self.lock:
+            for i in range(len(self.written)):
+                self.written[i] = -1
+
+    # Returns the old backend, which is no longer in use once this returns.
+    def replace_backend(self, backend):
+        with self.backend_lock:
+            old_backend, self.backend = self.backend, backend
+
+        return old_backend
+
+    # Write the desired value of every LED again, e.g. to a controller that has just been reconnected.
+    def redraw(self):
+        received = self.stats.clock() if self.stats is not None else 0
+
+        with self.lock:
+            for alsa_id, brightness in enumerate(self.desired):
+                if brightness < 0:
+                    continue
+
+                self.written[alsa_id] = -1
+
+                if not self.pending[alsa_id]:
+                    self.pending[alsa_id] = 1
+                    self.received[alsa_id] = received
+                    self.dirty.append(alsa_id)
+
+        if not self.deferred:
+            flush_frame(self)
+
+
+class LedRenderer(threading.Thread):
+    """Flush a LedFramebuffer to its backend at a fixed frame rate."""
+
+    def __init__(self, framebuffer, fps, debug=False):
+        super().__init__(name="led-renderer", daemon=True)
+        self.framebuffer = framebuffer
+        self.interval = 1 / fps
+        self.debug = debug
+        self.stopped = threading.Event()
+        self.frames = 0
+
+    def start(self):
+        self.framebuffer.deferred = True
+        super().start()
+
+    def run(self):
+        next_frame = time.monotonic()
+        next_report = next_frame + 1
+        reported = None
+        failing = False
+
+        while not self.stopped.wait(max(0, next_frame - time.monotonic())):
+            failing = flush_frame(self.framebuffer, failing)
+            self.frames += 1
+            now = time.monotonic()
+
+            # Skip frames we've missed rather than trying to catch up on them
+            next_frame = max(next_frame + self.interval, now)
+
+            if self.debug and now >= next_report:
+                next_report = now + 1
+                stats = (self.framebuffer.writes, self.framebuffer.suppressed, self.framebuffer.coalesced)
+
+                if stats != reported:
+                    reported = stats
+                    print(
+                        "[LED renderer] Frames: {}, Writes: {}, Suppressed: {}, Coalesced: {}".format(
+                            self.frames, *stats
+                        )
+                    )
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.framebuffer.deferred = False
+        flush_frame(self.framebuffer)
+
+
+# Flush a framebuffer, reporting the first of a run of failed writes rather than every one. The LEDs that couldn't be
+# written are retried on the next flush, and the caller carries on regardless, e.g. the backend is replaced when an
+# unplugged controller is reattached. Returns whether the write failed.
+def flush_frame(framebuffer, failing=False):
+    try:
+        framebuffer.flush()
+    except OSError as error:
+        if not failing:
+            print(f"[LEDs] Couldn't write LEDs ({error}). Carrying on.")
+
+        return True
+
+    return False
+
+
+# Equivalent of LedRenderer for the asyncio runtime, flushing from a task on the event loop instead of a thread.
+async def render_leds(framebuffer, fps):
+    loop = asyncio.get_running_loop()
+    interval = 1 / fps
+    next_frame = loop.time()
+    framebuffer.deferred = True
+
+    failing = False
+
+    try:
+        while True:
+            await asyncio.sleep(max(0, next_frame - loop.time()))
+            failing = flush_frame(framebuffer, failing)
+            next_frame = max(next_frame + interval, loop.time())
+    finally:
+        framebuffer.deferred = False
+        flush_frame(framebuffer)
@@ -1,16 +1,44 @@
 #!/usr/bin/env python3
 
-# TODO: allow user specified event code mappings via CLI option
-
 import argparse
+import array
+import asyncio
 import csv
 import evdev
+import fcntl
+import hashlib
+import marshal
 import os
 import re
 import rtmidi
-import subprocess
+import select
+import struct
+import sys
+import threading
 import time
 
+from traktor_s4_mk1_midify.debuglog import LOG_EVENT, LOG_RECEIVED, LOG_SENT, DebugLog
+from traktor_s4_mk1_midify.inotify import (
+    IN_ATTRIB,
+    IN_CLOSE_WRITE,
+    IN_CREATE,
+    IN_DELETE,
+    IN_MOVED_FROM,
+    IN_MOVED_TO,
+    Inotify,
+    InotifyWatcher,
+)
+from traktor_s4_mk1_midify.leds import (
+    LED_BACKENDS,
+    LedFramebuffer,
+    LedRenderer,
+    NullLedBackend,
+    open_led_backend,
+    render_leds,
+)
+from traktor_s4_mk1_midify.realtime import apply_realtime, collect_garbage, freeze_garbage_collector
+from traktor_s4_mk1_midify.stats import Stats, StatsFileWriter, dump_stats_on_sigusr1
+
 
 # Indicies are snd-usb-caiaq event codes, values are MIDI control change (CC) codes/channels.
 def load_midi_map_mixer_effect(filename=os.path.join(os.path.dirname(__file__), "midi-evcode-map-mixer-effect.csv")):
@@ -28,9 +56,6 @@ def load_midi_map_mixer_effect(filename=os.path.join(os.path.dirname(__file__),
     return mapping
 
 
-MIDI_MAP_MIXER_EFFECT = load_midi_map_mixer_effect()
-
-
 # Indicies are snd-usb-caiaq event codes, values are MIDI control change (CC) codes/channels.
 # Decks are affected by the shift modifier key and the deck toggle buttons, so we need to send different MIDI data based
 # on the state of these modifiers.
@@ -51,9 +76,6 @@ def load_midi_map_deck(filename=os.path.join(os.path.dirname(__file__), "midi-ev
     return mapping
 
 
-MIDI_MAP_DECK = load_midi_map_deck()
-
-
 def load_evcode_type_map(filename=os.path.join(os.path.dirname(__file__), "evcode-type-map.csv")):
     mapping = [None for _ in range(350)]
 
@@ -66,9 +88,6 @@ def load_evcode_type_map(filename=os.path.join(os.path.dirname(__file__), "evcod
     return mapping
 
 
-EVCODE_TYPE_MAP = load_evcode_type_map()
-
-
 def load_midi_alsa_control_map(filename=os.path.join(os.path.dirname(__file__), "midi-alsa-control-map.csv")):
     mapping = [None for _ in range(71)]
 
@@ -90,8 +109,19 @@ def load_midi_alsa_control_map(filename=os.path.join(os.path.dirname(__file__),
     return mapping
 
 
-MIDI_ALSA_CONTROL_MAP = load_midi_alsa_control_map()
-ALSA_DEV = subprocess.getoutput('aplay -l | grep "Traktor Kontrol S4" | cut -d " " -f 2').replace(":", "")
+# Mapping tables are loaded by load_mappings(), so that tools which don't need them don't pay for loading them.
+MIDI_MAP_MIXER_EFFECT = None
+MIDI_MAP_DECK = None
+EVCODE_TYPE_MAP = None
+MIDI_ALSA_CONTROL_MAP = None
+DISPATCH_TABLE = None
+
+# Name of the virtual MIDI ports for the first controller. Any others get "-2", "-3", etc. on the end.
+MIDI_PORT_NAME = "traktor-s4-mk1-midify"
+
+# rtmidi backends that the MIDI ports can be opened on (see --midi_api). JACK MIDI skips the ALSA sequencer's extra hop
+# through the kernel, but Mixxx only sees JACK ports when they're bridged to ALSA, e.g. by a2jmidid.
+MIDI_APIS = {"alsa": rtmidi.API_LINUX_ALSA, "jack": rtmidi.API_UNIX_JACK}
 
 
 def select_controller_device():
@@ -125,14 +155,212 @@ def detect_controller_device():
     quit()
 
 
-def detect_alsa_device():
-    if ALSA_DEV:
-        print("Detected ALSA device: ")
-        print(subprocess.getoutput('aplay -l | grep "Traktor Kontrol S4"'))
-    else:
-        print("Couldn't find your controller with aplay. Do you have snd-usb-caiaq installed / enabled?")
+# Returns [card number, card ID, description] for each ALSA sound card with a name containing the given string. Each
+# card takes up two lines in /proc/asound/cards, e.g.:
+#  1 [TraktorKontrolS]: snd-usb-caiaq - Traktor Kontrol S4
+#                       Native Instruments Traktor Kontrol S4 (usb-0000:07:00.0-2.2)
+def find_alsa_cards(name="Traktor Kontrol S4"):
+    cards = []
+
+    try:
+        with open("/proc/asound/cards") as cards_file:
+            lines = cards_file.read().splitlines()
+    except OSError:
+        return cards
+
+    for i, line in enumerate(lines):
+        match = re.match(r"\s*(\d+) \[(\S+)\s*\]: (.*)", line)
+
+        if match is None:
+            continue
+
+        description = match.group(3)
+
+        if i + 1 < len(lines) and not re.match(r"\s*\d+ \[", lines[i + 1]):
+            description += " " + lines[i + 1].strip()
+
+        if name in description:
+            cards.append([match.group(1), match.group(2), description])
+
+    return cards
+
+
+# An evdev's phys starts with the controller's USB path, e.g. usb-0000:07:00.0-2.2/input0, which the ALSA card's
+# description ends with, e.g. (usb-0000:07:00.0-2.2).
+def usb_path(phys):
+    return phys.split("/")[0]
+
+
+# Returns [[evdev, ALSA card number], ...] for the connected controllers, pairing each controller's evdev with its ALSA
+# card by USB path, and a list of the controller evdevs that couldn't be paired. Evdevs and cards that are already in
+# use can be left out with ignore_paths / ignore_cards.
+def find_controller_units(ignore_paths=(), ignore_cards=()):
+    devices = []
+
+    for path in evdev.list_devices():
+        if path in ignore_paths:
+            continue
+
+        try:
+            device = evdev.InputDevice(path)
+        except OSError:
+            # e.g. udev hasn't given us permission to open a device that has just been plugged in yet
+            continue
+
+        if "Traktor Kontrol S4" in device.name:
+            devices.append(device)
+        else:
+            device.close()
+
+    cards = [card for card in find_alsa_cards() if card[0] not in ignore_cards]
+    units = []
+    unpaired = []
+
+    for device in sorted(devices, key=lambda device: device.phys or ""):
+        paired = [card for card in cards if f"({usb_path(device.phys or '')})" in card[2]]
+
+        # Older kernels don't put the USB path in the card's description, which is fine if there's only one of each
+        if not paired and len(devices) == 1 and len(cards) == 1:
+            paired = cards
+
+        if paired:
+            units.append([device, paired[0][0]])
+        else:
+            unpaired.append(device)
+
+    return units, unpaired
+
+
+def detect_controller_units():
+    units, unpaired = find_controller_units()
+
+    for device in unpaired:
+        print(f"Couldn't find the ALSA card for {device.path} ({device.phys}). Ignoring it.")
+        device.close()
+
+    if not units and not unpaired:
+        print("Couldn't find your controller. Do you see it in the output of lsusb?")
+        quit()
+
+    if not units:
+        print("Couldn't find your controller in /proc/asound/cards. Do you have snd-usb-caiaq installed / enabled?")
         quit()
 
+    for device, card in units:
+        print("Detected evdev:")
+        print(f"{device.name}\t{device.path}\t{device.phys}")
+        print(f"Detected ALSA device: card {card}")
+
+    return units
+
+
+class EventFrameCoalescer:
+    """
+    Group events into the frames snd-usb-caiaq terminates with SYN_REPORT, keeping only the last value of each absolute
+    axis (pots, jogs, rotary encoders) in a frame. Button events are kept in order so that no presses are lost, and
+    axis values after a modifier key aren't folded into ones before it, so that they're sent on the (un)shifted control.
+
+    Events lost to SYN_DROPPED are replaced by a frame of just the SYN_DROPPED event, at which point the controller's
+    state should be read back from the device (see process_frame).
+    """
+
+    def __init__(self):
+        self.frame = []
+        self.positions = {}
+        self.dropped = None
+        self.events_in = 0
+        self.events_out = 0
+
+    # Drop any incomplete frame, e.g. when the controller has been unplugged part way through one.
+    def reset(self):
+        self.frame = []
+        self.positions = {}
+        self.dropped = None
+
+    # Returns a list of the frames completed by the events passed in. Incomplete frames are held until the next call.
+    def feed(self, events):
+        frames = []
+
+        for event in events:
+            if event.type == evdev.ecodes.EV_SYN:
+                if event.code == evdev.ecodes.SYN_REPORT:
+                    if self.dropped is not None:
+                        frames.append([self.dropped])
+                    elif self.frame:
+                        frames.append(self.frame)
+                        self.events_out += len(self.frame)
+
+                    self.frame = []
+                    self.positions = {}
+                    self.dropped = None
+                elif event.code == evdev.ecodes.SYN_DROPPED:
+                    # The kernel's buffer overflowed, so discard everything up to the next SYN_REPORT
+                    self.dropped = event
+
+                continue
+
+            self.events_in += 1
+
+            if event.type == evdev.ecodes.EV_KEY and event.code in MODIFIER_EVCODES:
+                self.positions = {}
+            elif event.type == evdev.ecodes.EV_ABS:
+                position = self.positions.get(event.code)
+
+                if position is not None:
+                    self.frame[position] = event
+                    continue
+
+                self.positions[event.code] = len(self.frame)
+
+            self.frame.append(event)
+
+        return frames
+
+
+# Wait for any of the controllers to have events available, then read all of each one's events with a single read() and
+# yield them as [unit, coalesced frame]. If timeout() returns a number of seconds and no events arrive in that time,
+# [None, []] is yielded instead, so that the caller can flush encoders that are due. Every controller is read from the
+# one thread, so a second controller costs a file descriptor in the select() rather than another process.
+#
+# With a ControllerSupervisor, controllers that are unplugged are detached rather than ending the loop, and reattached
+# by the supervisor when they come back.
+def read_unit_frames(units, timeout=lambda: None, supervisor=None):
+    while True:
+        devices = [unit["device"] for unit in units if unit["device"] is not None]
+
+        if supervisor is not None:
+            devices.append(supervisor)
+
+        readable, _, _ = select.select(devices, [], [], timeout())
+
+        if supervisor is not None and (supervisor in readable or supervisor.timeout() is not None):
+            supervisor.poll()
+
+        if not readable:
+            yield None, []
+            continue
+
+        for unit in units:
+            device = unit["device"]
+
+            if device is None or device not in readable:
+                continue
+
+            # read() returns a generator which only reads from the device once it's iterated, so read everything here
+            try:
+                events = list(device.read())
+            except BlockingIOError:
+                continue
+            except OSError as error:
+                if supervisor is None:
+                    raise
+
+                detach_unit(unit, error)
+                continue
+
+            for frame in unit["coalescer"].feed(events):
+                yield unit, frame
+
 
 def evcode_to_midi(evcode, shift_a, shift_b, toggle_ac, toggle_bd):
     if MIDI_MAP_MIXER_EFFECT[evcode] is not None:
@@ -170,16 +398,19 @@ def evcode_to_midi(evcode, shift_a, shift_b, toggle_ac, toggle_bd):
 
 
 def midi_to_alsa_control(midi_bytes):
-    cc = midi_bytes[1]
+    return row_to_alsa_control(MIDI_ALSA_CONTROL_MAP[midi_bytes[1]], midi_bytes)
+
 
-    if MIDI_ALSA_CONTROL_MAP[cc] is None:
+# Looks up the ALSA control for a MIDI message in its CC's row of MIDI_ALSA_CONTROL_MAP.
+def row_to_alsa_control(controls, midi_bytes):
+    if controls is None:
         return None
 
     # Bitwise & to get the lower 4 bytes of the MIDI CC
     channel = midi_bytes[0] & 0x4F
 
-    if channel < len(MIDI_ALSA_CONTROL_MAP[cc]):
-        return MIDI_ALSA_CONTROL_MAP[cc][channel]
+    if channel < len(controls):
+        return controls[channel]
     else:
         return None
 
@@ -189,54 +420,36 @@ def midi_to_alsa_control(midi_bytes):
 # Volume (0x7F). Subtract 1 from this value and use this value to set the right number of LEDs at the right brightness.
 #
 # We can skip a few brightness levels as we scale up so that we more or less linearly increase brightness.
-def set_vu_meter(controls, value):
-    light = value - 1  # ensure we stay <= 126
-    full_brightness = light // 18
+VU_METER_PARTIAL_BRIGHTNESS = [2, 4, 5, 7, 9, 10, 12, 14, 15, 17, 19, 21, 22, 24, 26, 28, 29, 31]
+
+
+def set_vu_meter(leds, controls, value):
+    brightness = [0 for _ in controls]
 
     if value:
+        light = value - 1  # ensure we stay <= 126
         full_brightness = light // 18
         partial = light % 18
 
-        for i in range(full_brightness):
-            set_led(controls[i], 31)
-
-        if partial:
-            alsa_values = [
-                2,
-                4,
-                5,
-                7,
-                9,
-                10,
-                12,
-                14,
-                15,
-                17,
-                19,
-                21,
-                22,
-                24,
-                26,
-                28,
-                29,
-                31,
-            ]
-            set_led(controls[full_brightness], alsa_values[partial - 1])
+        # The meters in MIDI_ALSA_CONTROL_MAP don't include the clip LED, so they max out a little early
+        for i in range(min(full_brightness, len(controls))):
+            brightness[i] = 31
 
-    for i in range(full_brightness, 6, 1):
-        set_led(controls[i], 0)
+        if partial and full_brightness < len(controls):
+            brightness[full_brightness] = VU_METER_PARTIAL_BRIGHTNESS[partial - 1]
 
+    leds.set(zip(controls, brightness))
 
-def set_led(alsa_id, brightness):
-    subprocess.call(
-        ["amixer", "-c", ALSA_DEV, "cset", f"numid={alsa_id}", str(brightness)],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
+
+def set_led(leds, alsa_id, brightness):
+    leds.set(((alsa_id, brightness),))
 
 
-def handle_midi_input(msg, args):
-    control = midi_to_alsa_control(msg[0])
+# Called from rtmidi's thread for each message on a controller's input port, with that controller's unit.
+def handle_midi_input(msg, unit):
+    # Only read MIDI_ALSA_CONTROL_MAP once, since it may be replaced by a mapping reload at any time (see load_mappings)
+    controls = MIDI_ALSA_CONTROL_MAP[msg[0][1]]
+    control = row_to_alsa_control(controls, msg[0])
 
     # If there is no ALSA control corresponding to the MIDI CC recieved, we should handle LED control between the
     # snd-usb-caiaq kernel module and this program (i.e. not communicate with Mixxx), as this seems to be the behaviour
@@ -244,190 +457,1105 @@ def handle_midi_input(msg, args):
     if control is None:
         return
 
-    if args.debug:
-        print(
-            "[Recieved MIDI message] Channel: {}, CC: {}, Value: {}".format(
-                hex(msg[0][0]), hex(msg[0][1]), hex(msg[0][2])
-            )
-        )
+    if unit["log"] is not None:
+        unit["log"].log(LOG_RECEIVED, -1, msg[0][0], msg[0][1], msg[0][2])
 
     value = msg[0][2]
 
     if isinstance(control, list):  # Vu meters
-        set_vu_meter(control, value)
+        set_vu_meter(unit["leds"], control, value)
+        return
+
+    brightness = 31 if value != 0 else 0
+    deck_leds = unit["deck_leds"]
+    channel = msg[0][0] & 0x0F
+
+    # LEDs which decks A/C (or B/D) share only show the active deck (see DeckLeds)
+    if deck_leds is not None and channel < 4 and controls[channel ^ 2] == control:
+        deck_leds.set(channel, control, brightness)
     else:  # All other MIDI controlled LEDs
-        if value != 0:
-            set_led(control, 31)
+        set_led(unit["leds"], control, brightness)
+
+
+class DeckLeds:
+    """
+    Lights the shift, deck toggle and channel active LEDs as soon as modifier state changes, and keeps the LED state
+    Mixxx sends for each deck.
+
+    Decks A/C (and B/D) share most of their LEDs. What Mixxx sends for a deck is cached and only shown while that deck
+    is active. When the deck toggles, the newly active deck's LEDs are redrawn from the cache in one batch, without any
+    round trip to Mixxx (which wouldn't know to resend them anyway).
+    """
+
+    def __init__(self, leds):
+        self.leds = leds
+        self.modifiers = 0
+        # Last brightness Mixxx sent for each shared LED, per deck (by MIDI channel), or -1 if it hasn't sent one
+        self.cache = [array.array("b", [-1 for _ in range(256)]) for _ in range(4)]
+        # set() is called from rtmidi's thread and update() from the event loop
+        self.lock = threading.Lock()
+
+    def active(self, channel):
+        return bool(self.modifiers & DECK_TOGGLE_LEDS[channel & 1][0]) == (channel >= 2)
+
+    def set(self, channel, alsa_id, brightness):
+        with self.lock:
+            self.cache[channel][alsa_id] = brightness
+
+            if self.active(channel):
+                self.leds.set(((alsa_id, brightness),))
+
+    # Light the LEDs for the given modifier state, redrawing any deck that has become active. If force is set, both
+    # sides are redrawn whether or not they've toggled, e.g. at startup.
+    def update(self, modifiers, force=False):
+        with self.lock:
+            changed = 0x0F if force else self.modifiers ^ modifiers
+            self.modifiers = modifiers
+            leds = []
+
+            for side, [modifier, _, _] in enumerate(DECK_TOGGLE_LEDS):
+                if not changed & modifier:
+                    continue
+
+                # LEDs the other deck lit that this one has no state for are turned off
+                toggled = bool(modifiers & modifier)
+                active = self.cache[side + 2 if toggled else side]
+                inactive = self.cache[side if toggled else side + 2]
+
+                for alsa_id in range(len(active)):
+                    if active[alsa_id] >= 0 or inactive[alsa_id] >= 0:
+                        leds.append((alsa_id, max(active[alsa_id], 0)))
+
+            # Drawn after the cached LEDs, so that they take priority if Mixxx has sent anything for the same LEDs. The
+            # framebuffer skips any that haven't changed.
+            for modifier, alsa_id in SHIFT_LEDS:
+                leds.append((alsa_id, 31 if modifiers & modifier else 0))
+
+            for modifier, deck_ab_leds, deck_cd_leds in DECK_TOGGLE_LEDS:
+                toggled = bool(modifiers & modifier)
+                leds.extend((alsa_id, 0 if toggled else 31) for alsa_id in deck_ab_leds)
+                leds.extend((alsa_id, 31 if toggled else 0) for alsa_id in deck_cd_leds)
+
+            self.leds.set(leds)
+
+
+# Rotary encoder messages are rate limited to one per ROT_THROTTLE_NS nanoseconds (jogs use their sensitivity setting).
+ROT_THROTTLE_NS = 5000000
+
+# _IOW('E', 0xa0, int) from linux/input.h
+EVIOCSCLOCKID = 0x400445A0
+
+
+# Ask the kernel to timestamp events from the controller with CLOCK_MONOTONIC instead of CLOCK_REALTIME, so that the
+# timestamps used for throttling aren't affected by NTP adjusting the wall clock. Returns whether this worked.
+def use_monotonic_timestamps(device):
+    try:
+        fcntl.ioctl(device.fd, EVIOCSCLOCKID, struct.pack("i", time.CLOCK_MONOTONIC))
+        return True
+    except OSError as error:
+        print(f"Couldn't switch controller event timestamps to the monotonic clock ({error}).")
+        return False
+
+
+# Throttling is based on the kernel's timestamp for each event rather than the time it's processed, so that recorded
+# events are translated exactly as they were live. Events without a timestamp fall back to the monotonic clock.
+def event_time_ns(event):
+    if event.sec or event.usec:
+        return event.sec * 1000000000 + event.usec * 1000
+
+    return time.monotonic_ns()
+
+
+class Encoder:
+    """
+    Accumulates the movement of a jog wheel or rotary encoder between the MIDI messages sent for it.
+
+    Movement is sent straight away if the encoder hasn't sent anything for `interval` nanoseconds. Otherwise it's held
+    until the interval is up and then sent by flush_encoders(), so that fast movement is rate limited without any of it
+    being stuck until the control moves again. Relative encoders send the accumulated change, split over as many
+    messages as it takes rather than clipped. Absolute encoders (gain) send their current value.
+    """
+
+    # There are only a handful of these, but they're touched for every jog / encoder event, so keep attribute access
+    # to fixed slots rather than a per-instance dict
+    __slots__ = [
+        "interval",
+        "steps",
+        "position",
+        "pending_encoders",
+        "offset",
+        "absolute",
+        "acceleration",
+        "counter",
+        "remainder",
+        "value",
+        "updated",
+        "pending",
+        "evcode",
+        "first_event_ns",
+        "status",
+        "cc",
+    ]
+
+    def __init__(self, interval, steps, position, pending_encoders, offset=None, absolute=False, acceleration=0):
+        self.interval = interval
+        self.steps = steps  # Number of control values per revolution, after which they wrap around
+        self.position = position  # [last control value], shared by decks using the same physical control
+        self.pending_encoders = pending_encoders
+        self.offset = offset  # None for two's complement relative values, otherwise the value meaning "no change"
+        self.absolute = absolute
+        self.acceleration = acceleration
+        self.counter = 0
+        self.remainder = 0.0
+        self.value = 0x3F
+        self.updated = 0
+        self.pending = False
+        self.evcode = 0
+        self.first_event_ns = 0
+        self.status = 0
+        self.cc = 0
+
+    def move(self, event, status, cc, now):
+        previous = self.position[0]
+        self.position[0] = event.value
+
+        if previous is None:
+            # Relative encoders need two values to work out a change. Gain starts in the middle, so that Mixxx has a
+            # value for it straight away.
+            if not self.absolute:
+                return
+
+            diff = 0
         else:
-            set_led(control, 0)
+            diff = event.value - previous
+
+            # Assume the shortest way round when the value wraps past its min / max
+            if diff > self.steps // 2:
+                diff -= self.steps
+            elif diff < -(self.steps // 2):
+                diff += self.steps
+
+        # If shift is pressed or released while movement is pending, the pending movement goes to the new CC
+        self.counter += diff
+        self.evcode = event.code
+        self.status = status
+        self.cc = cc
+
+        if not self.pending:
+            self.pending = True
+            self.first_event_ns = now
+            self.pending_encoders.append(self)
+
+    def deadline(self):
+        return self.updated + self.interval
+
+    # Send the movement accumulated since the last call, reusing `message` for each MIDI message. Returns the number of
+    # messages sent.
+    def send(self, outport, message, now, log=None):
+        self.pending = False
+        self.updated = now
+        delta = self.counter
+        self.counter = 0
+        message[0] = self.status
+        message[1] = self.cc
+
+        if self.absolute:
+            self.value = min(max(self.value + delta, 0), 0x7F)
+            message[2] = self.value
+            outport.send_message(message)
+
+            if log is not None:
+                log.log(LOG_SENT, self.evcode, self.status, self.cc, self.value)
+
+            return 1
+
+        if self.acceleration:
+            # Scale up fast movement, carrying the fractional part over so that slow movement isn't lost
+            scaled = delta * (1 + self.acceleration * abs(delta) / 64) + self.remainder
+            delta = int(scaled)
+            self.remainder = scaled - delta
+
+        sent = 0
+
+        while delta:
+            step = min(max(delta, -63), 63)
+            delta -= step
+            message[2] = step & 0x7F if self.offset is None else self.offset + step
+            outport.send_message(message)
+            sent += 1
+
+            if log is not None:
+                log.log(LOG_SENT, self.evcode, self.status, self.cc, message[2])
+
+        return sent
+
+
+# Send MIDI messages for every encoder whose interval is up (or for all of them if now is None).
+def flush_encoders(state, outport, now=None, log=None):
+    pending_encoders = state["pending_encoders"]
+
+    if not pending_encoders:
+        return
 
+    stats = state["stats"]
+    message = state["message"]
+    waiting = 0
 
-def calculate_jog_midi_value_update_jog_data(event, jog_data):
-    if jog_data["prev_control_value"] is None:
-        jog_data["prev_control_value"] = event.value
-        jog_data["updated"] = time.time()
-        return None, jog_data
+    # Encoders that aren't due yet are moved to the front of the list in place, rather than building a new list
+    for encoder in pending_encoders:
+        if now is not None and now < encoder.deadline():
+            pending_encoders[waiting] = encoder
+            waiting += 1
+            continue
 
-    # Get the change in the jog wheel control value since the last event
-    if event.value <= 255 and jog_data["prev_control_value"] >= 767:  # value increased past max
-        diff = 1024 - jog_data["prev_control_value"] + event.value
-    elif event.value >= 767 and jog_data["prev_control_value"] <= 255:  # value decreased past min
-        diff = event.value - 1024 - jog_data["prev_control_value"]
-    else:
-        diff = event.value - jog_data["prev_control_value"]  # value stayed within range
+        sent = encoder.send(outport, message, state["clock"]() if now is None else now, log)
 
-    jog_data["prev_control_value"] = event.value
+        if stats is not None and sent:
+            stats.event_to_midi.record(stats.clock() - encoder.first_event_ns)
+            stats.messages[encoder.evcode] += sent
 
-    # If it's been less than the interval specified in jog_sensitivity, store the cumulative jog wheel control value
-    # change for later and stop processing.
-    if time.time() - jog_data["updated"] < jog_data["sensitivity"]:
-        jog_data["counter"] += diff
-        return None, jog_data
-    else:
-        midi_value = jog_data["counter"] + diff
-        jog_data["counter"] = 0
-        jog_data["updated"] = time.time()
-
-        # Convert signed int value to unsigned values that Mixxx expects in jog wheel MIDI messages
-        if -64 <= midi_value < 0:
-            midi_value = 128 + midi_value
-        elif midi_value < -64:
-            midi_value = 64
-        elif midi_value >= 63:
-            midi_value = 63
-
-        return midi_value, jog_data
-
-
-def calculate_gain_midi_value_update_gain_data(event, gain_data):
-    if gain_data["prev_control_value"] is None:
-        gain_data["prev_control_value"] = event.value
-        gain_data["counter"] = 0x3F
-        gain_data["updated"] = time.time()
-        return 0x3F, gain_data
-
-    # Get the change in the rotary encoder value since the last event
-    if event.value <= 3 and gain_data["prev_control_value"] >= 12:  # value increased past max
-        diff = 16 - gain_data["prev_control_value"] + event.value
-    elif event.value >= 12 and gain_data["prev_control_value"] <= 3:  # value decreased past min
-        diff = event.value - 16 - gain_data["prev_control_value"]
-    else:
-        diff = event.value - gain_data["prev_control_value"]  # value stayed within range
+    del pending_encoders[waiting:]
 
-    gain_data["prev_control_value"] = event.value
 
-    # If it has been less than 5ms since last gain rot message, store cumulative gain rot control data for later and
-    # stop processing.
-    if time.time() - gain_data["updated"] < 0.005:
-        gain_data["counter"] += diff
-        return None, gain_data
-    else:
-        gain_data["counter"] += diff
-        gain_data["updated"] = time.time()
+# Nanoseconds on the state's clock at which flush_encoders() next needs to be called, or None if nothing is pending.
+def next_encoder_deadline(state):
+    if not state["pending_encoders"]:
+        return None
 
-        if gain_data["counter"] > 0x7F:
-            gain_data["counter"] = 0x7F
-        elif gain_data["counter"] < 0:
-            gain_data["counter"] = 0
+    return min(encoder.deadline() for encoder in state["pending_encoders"])
 
-        return gain_data["counter"], gain_data
 
+# Seconds until flush_encoders() next needs to be called, or None if nothing is pending.
+def encoder_timeout(state):
+    deadline = next_encoder_deadline(state)
 
-def calculate_rot_midi_value_update_rot_data(event, rot_data):
-    if rot_data["prev_control_value"] is None:
-        rot_data["prev_control_value"] = event.value
-        rot_data["updated"] = time.time()
-        return None, rot_data
+    if deadline is None:
+        return None
 
-    # Get the change in the rotary encoder value since the last event
-    if event.value <= 3 and rot_data["prev_control_value"] >= 12:  # value increased past max
-        diff = 16 - rot_data["prev_control_value"] + event.value
-    elif event.value >= 12 and rot_data["prev_control_value"] <= 3:  # value decreased past min
-        diff = event.value - 16 - rot_data["prev_control_value"]
-    else:
-        diff = event.value - rot_data["prev_control_value"]  # value stayed within range
+    return max(deadline - state["clock"](), 0) / 1e9
 
-    rot_data["prev_control_value"] = event.value
 
-    # If it has been less than 5ms since last rot message, store cumulative control data for later and stop processing.
-    if time.time() - rot_data["updated"] < 0.005:
-        rot_data["counter"] += diff
-        return None, rot_data
-    else:
-        midi_value = 0x3F + rot_data["counter"] + diff
-        rot_data["counter"] = 0
-        rot_data["updated"] = time.time()
-
-        if midi_value > 0x7F:
-            midi_value = 0x7F
-        elif midi_value < 0:
-            midi_value = 0
-
-        return midi_value, rot_data
-
-
-# Values ranges are translated from snd-usb-caiaq ranges to MIDI ranges based on the control type. For example,
-# a fader has a value range from 0-4095 in snd-usb-caiaq events, but Mixxx expects MIDI values between 0-127.
-# Thus, integer division by 32 converts the value for all fader CCs from snd-usb-caiaq to MIDI.
-def calculate_midi_value_update_controller_data(event, controller_data, toggle_ac, toggle_bd):
-    match EVCODE_TYPE_MAP[event.code]:
-        case "BTN":
-            return event.value, controller_data
-        case "POT":
-            value = event.value // 32
-            return value, controller_data
-        case "JOG_ROT":
-            # TODO: make these deck toggle aware
-            jog_rots = ["jog_a", "jog_b"]
-            jog_rot = jog_rots[event.code - 52]  # jog rot event codes are sequential beginning at 52
-
-            value, controller_data[jog_rot] = calculate_jog_midi_value_update_jog_data(event, controller_data[jog_rot])
-
-            return value, controller_data
-        case "BROWSE_ROT":
-            value, rot_data = calculate_rot_midi_value_update_rot_data(event, controller_data["browse_rot"])
-            controller_data["browse_rot"] = rot_data
-
-            return value, controller_data
-        case "ROT":
-            rots = ["move_rot_", "size_rot_", "move_rot_", "size_rot_"]
-            rot = rots[event.code - 55]  # move / size rot event codes are sequential beginning at 55
-
-            if event.code <= 56:
-                if toggle_ac:
-                    rot = rot + "c"
+# Seconds until flush_encoders() next needs to be called for any of the controllers, or None if nothing is pending.
+def units_encoder_timeout(units):
+    timeouts = [timeout for timeout in (encoder_timeout(unit["state"]) for unit in units) if timeout is not None]
+    return min(timeouts, default=None)
+
+
+# Modifier state is packed into 4 bits so that it can be combined with an event code to index DISPATCH_TABLE.
+SHIFT_A = 1
+SHIFT_B = 2
+TOGGLE_AC = 4
+TOGGLE_BD = 8
+
+# Event codes of the shift A, deck toggle A/C, shift B and deck toggle B/D buttons, handled in process_event
+MODIFIER_EVCODES = [257, 264, 313, 304]
+
+# ALSA numids of the LEDs midify lights itself, since Mixxx doesn't know about shift / deck toggle state (see
+# doc/amixer_controls.tsv). None of these are in midi-alsa-control-map.csv, so Mixxx can't overwrite them.
+# [modifier, LED]
+SHIFT_LEDS = [[SHIFT_A, 78], [SHIFT_B, 122]]
+
+# [modifier, LEDs lit while deck A / B is active, LEDs lit while deck C / D is active], i.e. the deck indicators, the
+# deck C / D button and the mixer's channel active LEDs
+DECK_TOGGLE_LEDS = [
+    [TOGGLE_AC, [86, 23], [87, 75, 49]],
+    [TOGGLE_BD, [130, 36], [131, 119, 62]],
+]
+
+
+# Translators return the MIDI value to send for an event, or None if no message should be sent for it straight away.
+def translate_button(event, encoder, status, cc):
+    return event.value
+
+
+def translate_pot(event, encoder, status, cc):
+    return event.value // 32
+
+
+# Jog wheels and rotary encoders send their MIDI messages from flush_encoders().
+def translate_encoder(event, encoder, status, cc):
+    encoder.move(event, status, cc, event_time_ns(event))
+
+
+def translate_jog_touch(event, encoder, status, cc):
+    if event.value >= 3050:
+        return 0x7F
+
+    return 0
+
+
+# Indicies are the handler indicies stored in DISPATCH_TABLE entries.
+TRANSLATORS = [
+    translate_button,
+    translate_pot,
+    translate_encoder,
+    translate_encoder,
+    translate_encoder,
+    translate_encoder,
+    translate_jog_touch,
+]
+
+TRANSLATOR_INDICIES = {
+    "BTN": 0,
+    "POT": 1,
+    "JOG_ROT": 2,
+    "BROWSE_ROT": 3,
+    "ROT": 4,
+    "GAIN_ROT": 5,
+    "JOG_TOUCH": 6,
+}
+
+# Encoders are referred to by their index in this list in DISPATCH_TABLE and controller data, so that nothing needs to
+# be looked up by name per event.
+ENCODER_NAMES = [
+    "browse_rot",
+    "jog_a",
+    "jog_b",
+    "jog_c",
+    "jog_d",
+    "move_rot_a",
+    "move_rot_b",
+    "move_rot_c",
+    "move_rot_d",
+    "size_rot_a",
+    "size_rot_b",
+    "size_rot_c",
+    "size_rot_d",
+    "gain_rot_a",
+    "gain_rot_b",
+    "gain_rot_c",
+    "gain_rot_d",
+]
+
+ENCODER_INDICIES = {name: index for index, name in enumerate(ENCODER_NAMES)}
+
+
+# Event codes of the controls with their own encoders (see compile_dispatch_table). Decks A/C share jog 52, move 55 and
+# size 56, decks B/D share jog 53, move 57 and size 58, and gains 59-62 are channels A-D.
+ENCODER_EVCODES = {"JOG_ROT": [52, 53], "ROT": [55, 56, 57, 58], "GAIN_ROT": [59, 60, 61, 62]}
+
+
+# Works out ahead of time everything evcode_to_midi and the control type decide per event.
+# Indicies are (event code << 4 | modifier bits), values are [MIDI status, MIDI CC, translator index, controller_data
+# index (see ENCODER_NAMES) or None] or None if the event shouldn't produce a MIDI message.
+def compile_dispatch_table(midi_map_mixer_effect, midi_map_deck, evcode_type_map):
+    table = [None for _ in range(len(evcode_type_map) << 4)]
+
+    for evcode, control_type in enumerate(evcode_type_map):
+        if control_type not in TRANSLATOR_INDICIES:
+            continue
+
+        # Each of these encoders belongs to a particular physical control, so they can't be given to other event codes
+        if control_type in ENCODER_EVCODES and evcode not in ENCODER_EVCODES[control_type]:
+            raise ValueError(f"Event code {evcode} can't be mapped as {control_type}")
+
+        for modifiers in range(16):
+            if midi_map_mixer_effect[evcode] is not None:
+                midi = midi_map_mixer_effect[evcode][1 if modifiers & (SHIFT_A | SHIFT_B) else 0]
+            elif evcode < len(midi_map_deck) and midi_map_deck[evcode] is not None:
+                # Decks B/D use 0xB1/0xB3, decks A/C use 0xB0/0xB2
+                if midi_map_deck[evcode][1][1] & 1 == 1:
+                    shift, toggle = SHIFT_B, TOGGLE_BD
                 else:
-                    rot = rot + "a"
+                    shift, toggle = SHIFT_A, TOGGLE_AC
+
+                midi = midi_map_deck[evcode][(2 if modifiers & toggle else 0) + (1 if modifiers & shift else 0)]
             else:
-                if toggle_bd:
-                    rot = rot + "d"
-                else:
-                    rot = rot + "b"
+                continue
+
+            match control_type:
+                case "JOG_ROT":
+                    if evcode == 52:
+                        encoder = "jog_c" if modifiers & TOGGLE_AC else "jog_a"
+                    else:
+                        encoder = "jog_d" if modifiers & TOGGLE_BD else "jog_b"
+                case "BROWSE_ROT":
+                    encoder = "browse_rot"
+                case "ROT":
+                    encoder = ["move_rot_", "size_rot_", "move_rot_", "size_rot_"][evcode - 55]
+
+                    if evcode <= 56:
+                        encoder += "c" if modifiers & TOGGLE_AC else "a"
+                    else:
+                        encoder += "d" if modifiers & TOGGLE_BD else "b"
+                case "GAIN_ROT":
+                    encoder = ["gain_rot_a", "gain_rot_b", "gain_rot_c", "gain_rot_d"][evcode - 59]
+                case _:
+                    encoder = None
+
+            if encoder is not None:
+                encoder = ENCODER_INDICIES[encoder]
+
+            table[evcode << 4 | modifiers] = [midi[1], midi[0], TRANSLATOR_INDICIES[control_type], encoder]
+
+    return table
+
+
+MAPPING_DIR = os.path.dirname(__file__)
+
+MAPPING_FILENAMES = [
+    "midi-evcode-map-mixer-effect.csv",
+    "midi-evcode-map-deck.csv",
+    "evcode-type-map.csv",
+    "midi-alsa-control-map.csv",
+]
+
+
+# Mapping files in a user specified directory override the packaged ones. Any that aren't there fall back to the
+# packaged defaults.
+def mapping_paths(mapping_dir):
+    paths = []
+
+    for filename in MAPPING_FILENAMES:
+        path = os.path.join(mapping_dir, filename)
+
+        if not os.path.exists(path):
+            path = os.path.join(MAPPING_DIR, filename)
+
+        paths.append(path)
+
+    return paths
+
+
+def compile_mappings(mapping_dir):
+    paths = mapping_paths(mapping_dir)
+    midi_map_mixer_effect = load_midi_map_mixer_effect(paths[0])
+    midi_map_deck = load_midi_map_deck(paths[1])
+    evcode_type_map = load_evcode_type_map(paths[2])
+    midi_alsa_control_map = load_midi_alsa_control_map(paths[3])
+    dispatch_table = compile_dispatch_table(midi_map_mixer_effect, midi_map_deck, evcode_type_map)
+
+    return [midi_map_mixer_effect, midi_map_deck, evcode_type_map, midi_alsa_control_map, dispatch_table]
+
+
+def mapping_cache_filename(mapping_dir):
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    mapping_dir_hash = hashlib.sha1(os.path.abspath(mapping_dir).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "traktor-s4-mk1-midify", f"mappings-{mapping_dir_hash}.marshal")
+
+
+# The cache is only valid for the same mapping files, the same code compiling them, and the same marshal format.
+def mapping_cache_key(mapping_dir):
+    key = [marshal.version, list(sys.version_info[:2])]
+
+    for path in mapping_paths(mapping_dir) + [__file__]:
+        stat = os.stat(path)
+        key.append([os.path.abspath(path), stat.st_mtime_ns, stat.st_size])
+
+    return key
+
+
+# Compiling the mapping tables means parsing four CSV files. Cache the result so that (re)starting only has to
+# unmarshal it, and recompile whenever any of the mapping files change.
+def load_cached_mappings(mapping_dir):
+    cache_filename = mapping_cache_filename(mapping_dir)
+    key = mapping_cache_key(mapping_dir)
+
+    try:
+        with open(cache_filename, "rb") as cache_file:
+            cached_key, mappings = marshal.loads(cache_file.read())
+
+        if cached_key == key:
+            return mappings
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    mappings = compile_mappings(mapping_dir)
+
+    try:
+        os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
 
-            value, controller_data[rot] = calculate_rot_midi_value_update_rot_data(event, controller_data[rot])
+        with open(f"{cache_filename}.tmp", "wb") as cache_file:
+            marshal.dump([key, mappings], cache_file)
 
-            return value, controller_data
-        case "GAIN_ROT":
-            gain_rots = ["gain_rot_a", "gain_rot_b", "gain_rot_c", "gain_rot_d"]
-            gain_rot = gain_rots[event.code - 59]  # gain rot event codes are sequential beginning at 59
+        os.replace(f"{cache_filename}.tmp", cache_filename)
+    except OSError as error:
+        print(f"Couldn't cache compiled mappings ({error}).")
 
-            value, rot_data = calculate_gain_midi_value_update_gain_data(event, controller_data[gain_rot])
-            controller_data[gain_rot] = rot_data
+    return mappings
 
-            return value, controller_data
-        case "JOG_TOUCH":
-            value = 0
 
-            if event.value >= 3050:
-                value = 0x7F
+# Raises ValueError if compiled mappings would produce invalid MIDI messages or refer to LEDs that don't exist.
+def validate_mappings(mappings):
+    evcode_type_map, midi_alsa_control_map, dispatch_table = mappings[2:]
 
-            return value, controller_data
-        case _:
-            return None, controller_data
+    for evcode, control_type in enumerate(evcode_type_map):
+        if control_type is not None and control_type not in TRANSLATOR_INDICIES:
+            raise ValueError(f"Unknown control type {control_type} for event code {evcode}")
+
+    for dispatch in dispatch_table:
+        if dispatch is not None and not (0xB0 <= dispatch[0] <= 0xBF and 0 <= dispatch[1] <= 0x7F):
+            raise ValueError(f"Invalid MIDI status / CC: {hex(dispatch[0])} / {hex(dispatch[1])}")
+
+    for cc, controls in enumerate(midi_alsa_control_map):
+        for control in controls or []:
+            for alsa_id in control if isinstance(control, list) else [control]:
+                if alsa_id is not None and not 0 < alsa_id < 256:
+                    raise ValueError(f"Invalid ALSA control {alsa_id} for MIDI CC {hex(cc)}")
+
+
+def load_mappings(mapping_dir=MAPPING_DIR):
+    global MIDI_MAP_MIXER_EFFECT, MIDI_MAP_DECK, EVCODE_TYPE_MAP, MIDI_ALSA_CONTROL_MAP, DISPATCH_TABLE
+    mappings = load_cached_mappings(mapping_dir)
+    validate_mappings(mappings)
+
+    # The hot paths each read only one of these per event / message (DISPATCH_TABLE in process_event and
+    # MIDI_ALSA_CONTROL_MAP in handle_midi_input), so replacing them one after the other never leaves either path with a
+    # mix of old and new mappings.
+    MIDI_MAP_MIXER_EFFECT, MIDI_MAP_DECK, EVCODE_TYPE_MAP, MIDI_ALSA_CONTROL_MAP, DISPATCH_TABLE = mappings
+
+
+# Called when files in a user specified mapping directory change. The new mappings are compiled and validated before
+# being swapped in, and the current mappings stay in use if anything is wrong with them.
+def reload_mappings(mapping_dir, changed_filenames):
+    if not set(changed_filenames) & set(MAPPING_FILENAMES):
+        return
+
+    try:
+        load_mappings(mapping_dir)
+        print(f"Reloaded mappings from {mapping_dir}")
+    except (OSError, ValueError, IndexError, KeyError, csv.Error) as error:
+        print(f"Couldn't reload mappings from {mapping_dir}, keeping the current mappings ({error!r}).")
+
+
+# Decks A/C and B/D share physical controls, so they share the last control value each encoder reported, but each deck
+# accumulates its own movement. Returns a list of Encoders in ENCODER_NAMES order.
+def create_controller_data(jog_sensitivity, pending_encoders, jog_acceleration=0):
+    encoders = {
+        "browse_rot": Encoder(ROT_THROTTLE_NS, 16, [None], pending_encoders, offset=0x3F),
+    }
+
+    for decks in ["ac", "bd"]:
+        jog_position = [None]
+        move_position = [None]
+        size_position = [None]
+
+        for deck in decks:
+            encoders[f"jog_{deck}"] = Encoder(
+                jog_sensitivity, 1024, jog_position, pending_encoders, acceleration=jog_acceleration
+            )
+
+            encoders[f"move_rot_{deck}"] = Encoder(ROT_THROTTLE_NS, 16, move_position, pending_encoders, offset=0x3F)
+
+            encoders[f"size_rot_{deck}"] = Encoder(ROT_THROTTLE_NS, 16, size_position, pending_encoders, offset=0x3F)
+
+    # Each mixer channel has its own gain knob
+    for deck in ["a", "b", "c", "d"]:
+        encoders[f"gain_rot_{deck}"] = Encoder(ROT_THROTTLE_NS, 16, [None], pending_encoders, absolute=True)
+
+    return [encoders[name] for name in ENCODER_NAMES]
+
+
+def create_state(jog_sensitivity, stats=None, jog_acceleration=0, clock=time.monotonic_ns, pot_hysteresis=0):
+    pending_encoders = []
+
+    return {
+        "modifiers": 0,
+        "control_values": [None for _ in range(350)],
+        # Last value sent for each MIDI status / CC, indexed by (channel << 7 | CC), or -1 if nothing has been sent
+        "sent_values": array.array("b", [-1 for _ in range(16 << 7)]),
+        "pot_hysteresis": pot_hysteresis,
+        "suppressed_messages": 0,
+        "controller_data": create_controller_data(jog_sensitivity, pending_encoders, jog_acceleration),
+        "pending_encoders": pending_encoders,
+        # Outgoing MIDI messages are written into this and sent, rather than allocating a list per message. rtmidi
+        # copies the message when it's sent, so it's safe to reuse straight away.
+        "message": [0, 0, 0],
+        "stats": stats,
+        # Must be the clock the kernel timestamps controller events with (see use_monotonic_timestamps)
+        "clock": clock,
+        "deck_leds": None,
+    }
+
+
+# Shift and deck toggle LEDs are lit here rather than by Mixxx, which doesn't know about either (see DeckLeds).
+def set_modifiers(state, modifiers):
+    state["modifiers"] = modifiers
+
+    if state["deck_leds"] is not None:
+        state["deck_leds"].update(modifiers)
+
+
+# Debug records go to `log` (a DebugLog) if one is given.
+def process_event(event, state, outport, log=None):
+    # TODO: When the following controls are used, it doesn't look like any events are sent. This looks to be caused
+    # by bugs in the snd-usb-caiaq module. Some events are recieved when the controls are used, but their evcodes
+    # are for other controls and their values don't change. Investigate.
+
+    # TODO: The footswitch doesn't send any events. It's hard to guess what evcode to expect here.
+
+    # TODO: The HI eq pot on deck C doesn't seem to send any event values either. Expect evcode 47, values 0-4095.
+
+    # TODO: Likewise for the loop recorder dry / wet pot. Expect evcode 20, values 0-4095.
+
+    stats = state["stats"]
+
+    if stats is not None:
+        stats.events[event.code] += 1
+
+    # Ignore events which don't change control values
+    if event.value == state["control_values"][event.code]:
+        return
+
+    state["control_values"][event.code] = event.value
+
+    if log is not None:
+        log.log(LOG_EVENT, event.code, -1, -1, event.value)
+
+    # Handle modifier key event codes (see MODIFIER_EVCODES)
+    if event.code == 257:
+        set_modifiers(state, state["modifiers"] ^ SHIFT_A)
+        return
+
+    if event.code == 264 and event.value:
+        set_modifiers(state, state["modifiers"] ^ TOGGLE_AC)
+        return
+
+    if event.code == 313:
+        set_modifiers(state, state["modifiers"] ^ SHIFT_B)
+        return
+
+    if event.code == 304 and event.value:
+        set_modifiers(state, state["modifiers"] ^ TOGGLE_BD)
+        return
+
+    dispatch = DISPATCH_TABLE[event.code << 4 | state["modifiers"]]
+
+    # Ignore events with no corresponding MIDI control defined
+    if dispatch is None:
+        return
+
+    status, cc, translator, encoder = dispatch
+    value = TRANSLATORS[translator](event, None if encoder is None else state["controller_data"][encoder], status, cc)
+
+    # Don't send a MIDI message if the translator doesn't return an appropriate value. Not all events should trigger a
+    # MIDI message straight away, even if they report that a control value has changed. For instance, it's desireable
+    # to rate limit the number of messages sent when the jog wheels are moved (since this generates a lot of events),
+    # so their messages are sent by flush_encoders().
+    if value is None:
+        return
+
+    # Only send real changes of MIDI value. Pots have 32 event values per MIDI value, so most of their events would
+    # otherwise repeat the last message sent. With hysteresis, a pot also has to move a little way past the edge of the
+    # range for the last value sent before a new one is, so that jitter at the edge doesn't flap between two values. The
+    # ends of the range are always sent, so that a fader can be fully closed or opened.
+    sent_values = state["sent_values"]
+    index = (status & 0x0F) << 7 | cc
+    last = sent_values[index]
+    hysteresis = state["pot_hysteresis"]
+
+    if value == last or (
+        hysteresis
+        and last >= 0
+        and translator == TRANSLATOR_INDICIES["POT"]
+        and 0 < value < 127
+        and last * 32 - hysteresis <= event.value < (last + 1) * 32 + hysteresis
+    ):
+        state["suppressed_messages"] += 1
+
+        if stats is not None:
+            stats.suppressed[event.code] += 1
+
+        return
+
+    sent_values[index] = value
+    message = state["message"]
+    message[0] = status
+    message[1] = cc
+    message[2] = value
+    outport.send_message(message)
+
+    if stats is not None:
+        stats.event_to_midi.record(stats.clock() - event_time_ns(event))
+        stats.messages[event.code] += 1
+
+    if log is not None:
+        log.log(LOG_SENT, event.code, status, cc, value)
+
+
+# Translate a coalesced frame of events, then send any encoder movement that's due as of the frame's timestamp. Throttle
+# windows are measured with the controller's own timestamps rather than when the frame happens to be processed, so that
+# live input and a replay of it give the same messages. Only flushes for deadlines that pass without any more events
+# (see encoder_timeout) use the state's clock.
+#
+# After events have been dropped, the controller's state is read back from `device`. Without one (e.g. replaying a
+# recording), the dropped events are just lost.
+def process_frame(frame, state, outport, log=None, device=None):
+    if frame[0].type == evdev.ecodes.EV_SYN:
+        if device is not None:
+            resync_controls(device, state, outport, log)
+
+        return
+
+    for event in frame:
+        process_event(event, state, outport, log)
+
+    flush_encoders(state, outport, event_time_ns(frame[0]), log)
+
+
+# Send whatever changed while events were being dropped, from the state of the controller's buttons and axes now. As
+# in detach_unit, buttons are released before modifiers so that they're released on the controls they were pressed on,
+# and modifiers are pressed before buttons. Jogs and encoders send the movement that was missed.
+def resync_controls(device, state, outport, log=None):
+    control_values = state["control_values"]
+    active_keys = set(device.active_keys())
+    released = []
+    pressed = []
+
+    for evcode in device.capabilities().get(evdev.ecodes.EV_KEY, []):
+        value = 1 if evcode in active_keys else 0
+
+        if value != (control_values[evcode] or 0):
+            (pressed if value else released).append(evcode)
+
+    released.sort(key=lambda evcode: evcode in MODIFIER_EVCODES)
+    pressed.sort(key=lambda evcode: evcode not in MODIFIER_EVCODES)
+
+    for evcode, value in [*((evcode, 0) for evcode in released), *((evcode, 1) for evcode in pressed)]:
+        process_event(synthetic_event(state, evdev.ecodes.EV_KEY, evcode, value), state, outport, log)
+
+    for evcode, absinfo in device.capabilities(absinfo=True).get(evdev.ecodes.EV_ABS, []):
+        process_event(synthetic_event(state, evdev.ecodes.EV_ABS, evcode, absinfo.value), state, outport, log)
+
+
+# Everything for one controller: its evdev, ALSA card, LED output, MIDI output and translation state. Controllers don't
+# share anything except stats. The device is None while the controller is unplugged (see ControllerSupervisor).
+def create_unit(device, card, leds, outport, state, debug=False, log=None):
+    state["deck_leds"] = DeckLeds(leds)
+    state["deck_leds"].update(0, force=True)
+
+    return {
+        "device": device,
+        "path": device.path,
+        "usb_path": usb_path(device.phys or ""),
+        "card": card,
+        "leds": leds,
+        "led_renderer": None,
+        "outport": outport,
+        "state": state,
+        "deck_leds": state["deck_leds"],
+        "coalescer": EventFrameCoalescer(),
+        "debug": debug,
+        "log": log,
+    }
+
+
+# Opens a controller's LED backend and MIDI ports, and creates its unit.
+def open_unit(number, device, card, args, jog_sensitivity, stats, clock, log):
+    led_backend = open_led_backend(card, args.led_backend)
+    leds = LedFramebuffer(led_backend)
+    port_name = MIDI_PORT_NAME if number == 0 else f"{MIDI_PORT_NAME}-{number + 1}"
+    midiin = rtmidi.MidiIn(MIDI_APIS[args.midi_api], name="blaxpot")
+    midiout = rtmidi.MidiOut(MIDI_APIS[args.midi_api], name="blaxpot")
+
+    if args.debug:
+        print(f"Using {led_backend.name} LED backend for card {card}, {args.midi_api} MIDI port {port_name}")
+
+    if stats is not None:
+        stats.leds.append(leds)
+        leds.stats = stats
+
+    state = create_state(jog_sensitivity, stats, args.jog_acceleration, clock, args.pot_hysteresis)
+    unit = create_unit(device, card, leds, midiout.open_virtual_port(name=port_name), state, args.debug, log)
+    unit["midiin"] = midiin
+    unit["inport"] = midiin.open_virtual_port(name=port_name)
+    unit["midiout"] = midiout
+
+    return unit
+
+
+def close_unit(unit):
+    unit["inport"].close_port()
+    unit["midiin"].delete()
+    unit["outport"].close_port()
+    unit["midiout"].delete()
+
+    if unit["device"] is not None:
+        unit["device"].close()
+
+    if unit["led_renderer"] is not None:
+        unit["led_renderer"].stop()
+
+    unit["leds"].backend.close()
+
+    if unit["debug"]:
+        leds = unit["leds"]
+        coalescer = unit["coalescer"]
+        print(f"[{unit['path']}]")
+        print(f"[LED writes] Issued: {leds.writes}, Suppressed: {leds.suppressed}, Coalesced: {leds.coalesced}")
+        print(f"[Events] Read: {coalescer.events_in}, After coalescing: {coalescer.events_out}")
+        print(f"[MIDI messages] Suppressed as duplicates: {unit['state']['suppressed_messages']}")
+
+
+# Runs everything for one controller on the asyncio event loop: evdev reads, MIDI input (handed over from rtmidi's
+# thread) and LED flushing, instead of the blocking read loop in midify() plus the rtmidi callback and LED renderer
+# threads. With a supervisor, an unplugged controller is detached and its task waits for the supervisor to reattach it.
+async def midify_unit_async(unit, args, supervisor=None):
+    loop = asyncio.get_running_loop()
+    state = unit["state"]
+    outport = unit["outport"]
+    coalescer = unit["coalescer"]
+    unit["inport"].set_callback(lambda msg, data: loop.call_soon_threadsafe(handle_midi_input, msg, data), unit)
+    led_task = None
+    flush_timer = None
+
+    if args.led_fps > 0:
+        led_task = asyncio.create_task(render_leds(unit["leds"], args.led_fps))
+
+    def schedule_flush():
+        nonlocal flush_timer
+
+        if flush_timer is not None:
+            flush_timer.cancel()
+
+        timeout = encoder_timeout(state)
+        flush_timer = None if timeout is None else loop.call_later(timeout, flush_on_timeout)
+
+    # No more events arrived before the next encoder deadline
+    def flush_on_timeout():
+        flush_encoders(state, outport, state["clock"](), unit["log"])
+        schedule_flush()
+
+    try:
+        while True:
+            if unit["device"] is None:
+                await asyncio.sleep(HOTPLUG_RETRY_SECONDS)
+                continue
+
+            try:
+                events = list(await unit["device"].async_read())
+            except OSError as error:
+                if supervisor is None:
+                    raise
+
+                detach_unit(unit, error)
+                continue
+
+            for frame in coalescer.feed(events):
+                process_frame(frame, state, outport, unit["log"], unit["device"])
+
+            schedule_flush()
+    finally:
+        unit["inport"].cancel_callback()
+
+        if flush_timer is not None:
+            flush_timer.cancel()
+
+        if led_task is not None:
+            led_task.cancel()
+            await asyncio.gather(led_task, return_exceptions=True)
+
+
+# Where evdevs appear when a controller is plugged in
+INPUT_DIR = "/dev/input"
+
+# After something changes in INPUT_DIR, try to reattach unplugged controllers this often for up to HOTPLUG_RETRY_WINDOW
+# seconds, since udev may not have given us permission to open the new evdev, or the ALSA card may not be registered,
+# when the evdev first appears.
+HOTPLUG_RETRY_SECONDS = 0.05
+HOTPLUG_RETRY_WINDOW = 3
+
+
+# Called when reading from a controller fails because it has been unplugged. Its MIDI ports stay open, so Mixxx doesn't
+# notice anything beyond the controller going quiet, and its LEDs are kept in the framebuffer until it comes back.
+def detach_unit(unit, error):
+    print(f"Lost the controller at {unit['path']} ({error}). Waiting for it to be plugged back in.")
+    state = unit["state"]
+    control_values = state["control_values"]
+
+    # Release any buttons that were held down, e.g. so that Mixxx doesn't keep previewing a cue. Modifiers go last, so
+    # that the other buttons are released on the (shifted) controls they were pressed on.
+    held = [evcode for evcode in range(256, len(control_values)) if control_values[evcode]]
+    held.sort(key=lambda evcode: evcode in MODIFIER_EVCODES)
+
+    for evcode in held:
+        process_event(synthetic_event(state, evdev.ecodes.EV_KEY, evcode, 0), state, unit["outport"], unit["log"])
+
+    try:
+        unit["device"].close()
+    except OSError:
+        pass
+
+    unit["device"] = None
+    unit["coalescer"].reset()
+
+    try:
+        unit["leds"].replace_backend(NullLedBackend()).close()
+    except OSError:
+        pass
+
+
+# Called by ControllerSupervisor when an unplugged controller is back, with its new evdev, ALSA card and LED backend.
+def attach_unit(unit, device, card, led_backend):
+    state = unit["state"]
+    use_monotonic_timestamps(device)
+    unit["device"] = device
+    unit["path"] = device.path
+    unit["usb_path"] = usb_path(device.phys or "")
+    unit["card"] = card
+    unit["leds"].replace_backend(led_backend).close()
+    unit["leds"].redraw()
+
+    # The controller's pots / encoders may have moved while it was unplugged. Encoders start counting from wherever they
+    # are now, and pots send their current value (which only reaches Mixxx if its MIDI value has changed).
+    for evcode in range(len(state["control_values"])):
+        state["control_values"][evcode] = None
+
+    for encoder in state["controller_data"]:
+        encoder.position[0] = None
+
+    for evcode, absinfo in device.capabilities(absinfo=True).get(evdev.ecodes.EV_ABS, []):
+        process_event(synthetic_event(state, evdev.ecodes.EV_ABS, evcode, absinfo.value), state, unit["outport"])
+
+
+# An event timestamped now by the state's clock, for state changes that didn't come from the controller.
+def synthetic_event(state, event_type, code, value):
+    now = state["clock"]()
+    return evdev.InputEvent(now // 1000000000, now // 1000 % 1000000, event_type, code, value)
+
+
+class ControllerSupervisor:
+    """
+    Watch INPUT_DIR with inotify and reattach controllers that have been unplugged as soon as they're plugged back in,
+    so that knocking the USB cable out doesn't mean restarting midify and Mixxx.
+
+    If a controller comes back on the same USB port it goes back to the unit it was unplugged from. Otherwise it goes to
+    any unit that's waiting for its controller. The event loop selects on this (see fileno) and calls poll() when it's
+    readable or timeout() has passed.
+    """
+
+    def __init__(self, units, led_backend="auto", path=INPUT_DIR, find=find_controller_units, open_backend=None):
+        self.units = units
+        self.led_backend = led_backend
+        self.find = find
+        self.open_backend = open_backend or open_led_backend
+        self.inotify = Inotify()
+        self.inotify.add_watch(path, IN_CREATE | IN_ATTRIB)
+        self.retry_until = 0
+
+    def fileno(self):
+        return self.inotify.fd
+
+    def detached(self):
+        return [unit for unit in self.units if unit["device"] is None]
+
+    # Seconds until poll() should next be called, or None if it only needs to be called when INPUT_DIR changes.
+    def timeout(self):
+        if self.detached() and time.monotonic() < self.retry_until:
+            return HOTPLUG_RETRY_SECONDS
+
+        return None
+
+    def poll(self):
+        if self.inotify.read():
+            self.retry_until = time.monotonic() + HOTPLUG_RETRY_WINDOW
+
+        if self.detached() and time.monotonic() < self.retry_until:
+            self.reattach()
+
+    def reattach(self):
+        detached = self.detached()
+        attached = [unit for unit in self.units if unit["device"] is not None]
+        pairs, unpaired = self.find([unit["path"] for unit in attached], [unit["card"] for unit in attached])
+
+        # Evdevs without an ALSA card yet are tried again on the next poll
+        for device in unpaired:
+            device.close()
+
+        for device, card in pairs:
+            path = usb_path(device.phys or "")
+            unit = next((unit for unit in detached if unit["usb_path"] == path), detached[0] if detached else None)
+
+            if unit is None:
+                device.close()
+                continue
+
+            try:
+                led_backend = self.open_backend(card, self.led_backend)
+            except OSError as error:
+                print(f"Couldn't open the LED backend for card {card} ({error}). Trying again.")
+                device.close()
+                continue
+
+            detached.remove(unit)
+            attach_unit(unit, device, card, led_backend)
+            print(f"Reattached the controller at {device.path} (card {card}).")
+
+    def close(self):
+        self.inotify.close()
+
+
+# With --realtime, the garbage collector only runs once there have been no controller events for this many seconds
+IDLE_GC_SECONDS = 1
+
+
+async def collect_garbage_when_idle(units):
+    events = None
+
+    while True:
+        await asyncio.sleep(IDLE_GC_SECONDS)
+        previous_events, events = events, sum(unit["coalescer"].events_in for unit in units)
+
+        if events == previous_events and units_encoder_timeout(units) is None:
+            collect_garbage()
+
+
+# Polls the supervisor whenever INPUT_DIR changes, and again after its timeout while it's waiting for a controller.
+async def supervise_async(supervisor):
+    loop = asyncio.get_running_loop()
+    retry_timer = None
+
+    def poll():
+        nonlocal retry_timer
+
+        if retry_timer is not None:
+            retry_timer.cancel()
+
+        supervisor.poll()
+        timeout = supervisor.timeout()
+        retry_timer = None if timeout is None else loop.call_later(timeout, poll)
+
+    loop.add_reader(supervisor.fileno(), poll)
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        loop.remove_reader(supervisor.fileno())
+
+        if retry_timer is not None:
+            retry_timer.cancel()
+
+
+async def midify_async(units, args, supervisor=None):
+    tasks = [midify_unit_async(unit, args, supervisor) for unit in units]
+
+    if supervisor is not None:
+        tasks.append(supervise_async(supervisor))
+
+    if args.realtime:
+        tasks.append(collect_garbage_when_idle(units))
+
+    await asyncio.gather(*tasks)
+
+
+# Parses a comma separated list of (decimal or 0x prefixed hex) numbers for command line options.
+def number_set(text):
+    return {int(number, 0) for number in text.split(",")}
+
+
+# Parses --pot_hysteresis. Pots have 32 event values per MIDI value, so any more hysteresis than that would keep a pot
+# from ever moving to the values either side of the last one sent.
+def pot_hysteresis(text):
+    hysteresis = int(text)
+
+    if not 0 <= hysteresis < 32:
+        raise argparse.ArgumentTypeError("must be between 0 and 31")
+
+    return hysteresis
 
 
 def midify():
-    jog_sensitivity = 0.005
+    jog_sensitivity = 5000000
 
     parser = argparse.ArgumentParser(
         description="Convert events generated by the snd-usb-caiaq kernel module to MIDI signals"
@@ -440,139 +1568,251 @@ def midify():
         help="Adjust jog wheel sensitivity (min: 1, max: 100, default: 5)",
     )
 
+    parser.add_argument(
+        "--jog_acceleration",
+        type=float,
+        default=0,
+        help="Scale up fast jog wheel movement by this much, e.g. 1 doubles a full speed spin (default: 0, no scaling)",
+    )
+
+    parser.add_argument(
+        "-p",
+        "--pot_hysteresis",
+        type=pot_hysteresis,
+        default=0,
+        help="How far (out of 4096) pots must move past the edge of their last MIDI value to send another (max: 31, "
+        "default: 0)",
+    )
+
+    parser.add_argument(
+        "-m",
+        "--mapping_dir",
+        help="Directory of mapping CSV files to use instead of the packaged ones. Changes are applied while running.",
+    )
+
+    parser.add_argument(
+        "-l",
+        "--led_backend",
+        choices=["auto", *LED_BACKENDS],
+        default="auto",
+        help="How to write LED values to the ALSA control interface (default: auto)",
+    )
+
+    parser.add_argument(
+        "--midi_api",
+        choices=MIDI_APIS,
+        default="alsa",
+        help="rtmidi backend to open the MIDI ports on (default: alsa)",
+    )
+
+    parser.add_argument(
+        "-f",
+        "--led_fps",
+        type=int,
+        default=60,
+        help="LED updates per second (default: 60, 0 writes LEDs as soon as MIDI is received)",
+    )
+
+    parser.add_argument(
+        "-a",
+        "--async",
+        dest="async_runtime",
+        action="store_true",
+        help="Handle controller events, MIDI input and LED output on a single asyncio event loop",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--stats",
+        action="store_true",
+        help="Collect latency histograms and event counters, printed to stderr when sent SIGUSR1",
+    )
+
+    parser.add_argument(
+        "--stats_file",
+        help="Periodically write stats to this file in Prometheus text format (implies --stats)",
+    )
+
+    parser.add_argument(
+        "--stats_interval",
+        type=float,
+        default=10,
+        help="Seconds between writes to the stats file (default: 10)",
+    )
+
+    parser.add_argument(
+        "-r",
+        "--realtime",
+        action="store_true",
+        help="Use SCHED_FIFO scheduling, lock memory and only collect garbage while idle, as far as permitted",
+    )
+
+    parser.add_argument(
+        "--realtime_priority",
+        type=int,
+        default=50,
+        help="SCHED_FIFO priority to use with --realtime (min: 1, max: 99, default: 50)",
+    )
+
+    parser.add_argument("--cpu", type=int, help="Pin the event loop to this CPU (with --realtime)")
     parser.add_argument("-d", "--debug", action="store_true", help="Show debug log messages")
+
+    parser.add_argument(
+        "--debug_evcodes",
+        type=number_set,
+        help="Only log these controller event codes, e.g. 52,53 (with --debug)",
+    )
+
+    parser.add_argument(
+        "--debug_ccs",
+        type=number_set,
+        help="Only log MIDI messages with these CCs, e.g. 0x46,0x47 (with --debug)",
+    )
+
+    parser.add_argument("--debug_file", help="Write the debug log to this file instead of stdout (implies --debug)")
+
+    parser.add_argument(
+        "--debug_binary",
+        action="store_true",
+        help="Write the debug log file as binary records, for traktor-s4-mk1-debug-log to print later",
+    )
+
     args = parser.parse_args()
+    args.debug = args.debug or bool(args.debug_file)
+
+    if args.debug_binary and not args.debug_file:
+        print("--debug_binary needs --debug_file.")
+        quit()
+
+    if MIDI_APIS[args.midi_api] not in rtmidi.get_compiled_api():
+        print(f"python-rtmidi was built without {args.midi_api} support.")
+        quit()
 
     if args.jog_sensitivity and 0 < int(args.jog_sensitivity) <= 100:
-        jog_sensitivity = int(args.jog_sensitivity) * 0.001
+        jog_sensitivity = int(args.jog_sensitivity) * 1000000
     else:
         print("Jog sensitivity must be between 1 and 100. Using default value (5).")
 
-    detect_alsa_device()
-    traktor_s4 = detect_controller_device()
-    midiin = rtmidi.MidiIn(name="blaxpot")
-    inport = midiin.open_virtual_port(name="traktor-s4-mk1-midify")
-    inport.set_callback(handle_midi_input, args)
-    midiout = rtmidi.MidiOut(name="blaxpot")
-    outport = midiout.open_virtual_port(name="traktor-s4-mk1-midify")
-    shift_a = False
-    shift_b = False
-    toggle_ac = False
-    toggle_bd = False
-    control_values = [None for _ in range(350)]
-
-    controller_data = {
-        "jog_a": {
-            "counter": 0,
-            "prev_control_value": None,
-            "sensitivity": jog_sensitivity,
-            "updated": time.time(),
-        },
-        "jog_b": {
-            "counter": 0,
-            "prev_control_value": None,
-            "sensitivity": jog_sensitivity,
-            "updated": time.time(),
-        },
-        "browse_rot": {
-            "counter": 0,
-            "prev_control_value": None,
-            "updated": time.time(),
-        },
-    }
+    mapping_watcher = None
 
-    for control in ["move", "size", "gain"]:
-        for deck in ["a", "b", "c", "d"]:
-            rotary_encoder = "{}_rot_{}".format(control, deck)
+    if args.mapping_dir:
+        # Missing files fall back to the packaged mappings, so a mistyped directory would otherwise load without a word
+        if not os.path.isdir(args.mapping_dir):
+            print(f"Mapping directory {args.mapping_dir} doesn't exist.")
+            quit()
 
-            controller_data[rotary_encoder] = {
-                "counter": 0,
-                "prev_control_value": None,
-                "updated": time.time(),
-            }
+        try:
+            load_mappings(args.mapping_dir)
+        except (OSError, ValueError, IndexError, KeyError, csv.Error) as error:
+            print(f"Couldn't load mappings from {args.mapping_dir} ({error!r}).")
+            quit()
 
-    for event in traktor_s4.read_loop():
-        # TODO: When the following controls are used, it doesn't look like any events are sent. This looks to be caused
-        # by bugs in the snd-usb-caiaq module. Some events are recieved when the controls are used, but their evcodes
-        # are for other controls and their values don't change. Investigate.
+        mapping_watcher = InotifyWatcher(
+            args.mapping_dir,
+            IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE,
+            lambda changed_filenames: reload_mappings(args.mapping_dir, changed_filenames),
+        )
 
-        # TODO: The footswitch doesn't send any events. It's hard to guess what evcode to expect here.
+        mapping_watcher.start()
+    else:
+        load_mappings()
 
-        # TODO: The HI eq pot on deck C doesn't seem to send any event values either. Expect evcode 47, values 0-4095.
+    devices = detect_controller_units()
 
-        # TODO: Likewise for the loop recorder dry / wet pot. Expect evcode 20, values 0-4095.
+    # Only use the monotonic clock if every controller's timestamps could be switched over to it
+    clock = time.monotonic_ns if all([use_monotonic_timestamps(device) for device, _ in devices]) else time.time_ns
+    stats = None
+    stats_file_writer = None
 
-        # Ignore events which don't change control values
-        if event.value == control_values[event.code]:
-            continue
+    if args.stats or args.stats_file:
+        stats = Stats(clock)
+        stats.leds = []
+        dump_stats_on_sigusr1(stats)
 
-        control_values[event.code] = event.value
+        if args.stats_file:
+            stats_file_writer = StatsFileWriter(stats, args.stats_file, args.stats_interval)
+            stats_file_writer.start()
 
-        if args.debug:
-            print(
-                "[Processing event] Code: {}, Value: {}, Timestamp: {}".format(
-                    event.code, event.value, event.timestamp()
-                )
-            )
+    log = None
 
-        # Handle modifier key event codes
-        if event.code == 257:
-            shift_a = not shift_a
-            continue
+    if args.debug:
+        log = DebugLog(args.debug_file, args.debug_binary, args.debug_evcodes, args.debug_ccs)
+        log.start()
 
-        if event.code == 264 and event.value:
-            toggle_ac = not toggle_ac
-            continue
+    units = [
+        open_unit(number, device, card, args, jog_sensitivity, stats, clock, log)
+        for number, [device, card] in enumerate(devices)
+    ]
 
-        if event.code == 313:
-            shift_b = not shift_b
-            continue
+    supervisor = None
 
-        if event.code == 304 and event.value:
-            toggle_bd = not toggle_bd
-            continue
+    try:
+        supervisor = ControllerSupervisor(units, args.led_backend)
+    except OSError as error:
+        print(f"Couldn't watch {INPUT_DIR} for controllers being plugged back in ({error}).")
 
-        # TODO: Handle LED controls that don't respond to MIDI messages on macOS/Windows e.g. deck toggles, shift
-        # buttons, deck active LEDs, etc.
+    if not args.async_runtime:
+        for unit in units:
+            unit["inport"].set_callback(handle_midi_input, unit)
 
-        midi = evcode_to_midi(event.code, shift_a, shift_b, toggle_ac, toggle_bd)
+            if args.led_fps > 0:
+                unit["led_renderer"] = LedRenderer(unit["leds"], args.led_fps, args.debug)
+                unit["led_renderer"].start()
 
-        # Ignore events with no corresponding MIDI control defined
-        if midi is None:
-            continue
+    # SCHED_FIFO and the CPU pin only apply to the calling thread (and threads it starts later), so they're applied once
+    # every helper thread (debug log, stats file, mapping watcher, rtmidi input, LED renderers) is already running on
+    # the normal scheduler, leaving only the event loop at real-time priority
+    if args.realtime:
+        failed = apply_realtime(args.realtime_priority, args.cpu)
 
-        value, controller_data = calculate_midi_value_update_controller_data(
-            event, controller_data, toggle_ac, toggle_bd
-        )
+        if failed:
+            print("Couldn't apply some real-time settings: {}.".format(", ".join(failed)))
 
-        # Don't send a MIDI message if calculate_midi_value_update_controller_data doesn't return an appropriate value.
-        # Not all events should trigger a MIDI message, even if they report that a control value has changed. For
-        # instance, it's desireable to rate limit the number of messages sent when the jog wheels are moved (since
-        # this generates a lot of events).
-        if value is None:
-            continue
+        # Everything from here on should be allocation free, apart from garbage that's collected while idle
+        freeze_garbage_collector()
 
-        outport.send_message([midi[1], midi[0], value])
+    try:
+        if args.async_runtime:
+            asyncio.run(midify_async(units, args, supervisor))
+        else:
+            idle = False
 
-        if args.debug:
-            print("[Sent MIDI message] Channel: {}, CC: {}, Value: {}".format(hex(midi[1]), hex(midi[0]), hex(value)))
+            # With --realtime, wake up to collect garbage after IDLE_GC_SECONDS without any controller events
+            def timeout():
+                nonlocal idle
+                timeouts = [units_encoder_timeout(units), None if supervisor is None else supervisor.timeout()]
+                pending = min([timeout for timeout in timeouts if timeout is not None], default=None)
+                idle = pending is None
+                return IDLE_GC_SECONDS if idle and args.realtime else pending
 
-    inport.close_port()
-    midiin.delete()
-    outport.close_port()
-    midiout.delete()
-    traktor_s4.close()
+            for unit, frame in read_unit_frames(units, timeout, supervisor):
+                if unit is None and idle:
+                    collect_garbage()
 
+                if unit is not None:
+                    process_frame(frame, unit["state"], unit["outport"], log, unit["device"])
 
-def print_events():
-    traktor_s4 = detect_controller_device()
-    control_values = [None for _ in range(350)]
+                # Other controllers' encoders may have come due while this one was busy (or nothing arrived before the
+                # next deadline), which is only known from the clock
+                now = clock()
 
-    for event in traktor_s4.read_loop():
-        if event.value == control_values[event.code]:
-            continue
+                for flushed_unit in units:
+                    if flushed_unit is not unit:
+                        flush_encoders(flushed_unit["state"], flushed_unit["outport"], now, log)
+    except KeyboardInterrupt:
+        pass
+
+    for unit in units:
+        close_unit(unit)
+
+    if supervisor is not None:
+        supervisor.close()
+
+    if stats_file_writer is not None:
+        stats_file_writer.stop()
 
-        control_values[event.code] = event.value
-        print(event)
+    if mapping_watcher is not None:
+        mapping_watcher.stop()
 
-    traktor_s4.close()
+    if log is not None:
+        log.stop()
@@ -0,0 +1,52 @@
+# Real-time scheduling for midify: SCHED_FIFO priority, CPU pinning, locked memory and garbage collection only while
+# idle. Whether each of these is permitted depends on rlimits / capabilities (see RLIMIT_RTPRIO and RLIMIT_MEMLOCK in
+# `man setrlimit`), so each step is attempted separately and anything that can't be applied is reported instead of being
+# treated as an error.
+
+import ctypes
+import ctypes.util
+import gc
+import os
+
+# From sys/mman.h
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+
+# The CPU pin and SCHED_FIFO apply to the calling thread, and to every thread it starts afterwards (they inherit its
+# scheduling policy and CPU affinity), so this should be called from the event loop's thread once any helper threads
+# have been started. Locking memory applies to the whole process. Returns a description of each step that couldn't be
+# applied.
+def apply_realtime(priority=50, cpu=None):
+    failed = []
+
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except (OSError, ValueError) as error:
+            failed.append(f"pinning to CPU {cpu} ({error})")
+
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except (OSError, ValueError) as error:
+        failed.append(f"SCHED_FIFO priority {priority} ({error})")
+
+    # Keep everything mapped now or later in RAM, so that the event loop never waits on a page fault
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        failed.append(f"locking memory ({os.strerror(ctypes.get_errno())})")
+
+    return failed
+
+
+# Everything allocated during startup (mappings, state, ports) lives until exit, so move it out of the collector's way
+# and stop collections from being triggered by allocations. Call collect_garbage() when idle instead.
+def freeze_garbage_collector():
+    gc.collect()
+    gc.freeze()
+    gc.disable()
+
+
+def collect_garbage():
+    gc.collect()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+# Record raw controller events to a file and replay them through the midify pipeline, so that translation can be tested
+# and load tested without a controller attached.
+#
+# A recording is a 16 byte header followed by one fixed size record per evdev event, laid out like the kernel's struct
+# input_event on 64 bit machines (seconds, microseconds, type, code, value). Records can be read straight out of a
+# memory-mapped file without any parsing beyond struct.unpack.
+
+import argparse
+import evdev
+import itertools
+import mmap
+import struct
+import time
+
+from traktor_s4_mk1_midify import midify
+from traktor_s4_mk1_midify.debuglog import DebugLog
+
+RECORDING_MAGIC = b"TS4MK1EV"
+RECORDING_VERSION = 1
+RECORDING_HEADER = struct.Struct("<8sI4x")
+RECORDING_EVENT = struct.Struct("<qqHHi")
+
+
+def write_recording_header(recording):
+    recording.write(RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION))
+
+
+def write_recording_event(recording, event):
+    recording.write(RECORDING_EVENT.pack(event.sec, event.usec, event.type, event.code, event.value))
+
+
+def read_recording(filename):
+    with open(filename, "rb") as recording:
+        with mmap.mmap(recording.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version = RECORDING_HEADER.unpack_from(data)
+
+            if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+                raise ValueError(f"{filename} isn't a traktor-s4-mk1-midify recording")
+
+            # Ignore a partially written record at the end, e.g. if the recorder was killed
+            start = RECORDING_HEADER.size
+            end = len(data) - (len(data) - start) % RECORDING_EVENT.size
+
+            with memoryview(data)[start:end] as records:
+                for sec, usec, event_type, code, value in RECORDING_EVENT.iter_unpack(records):
+                    yield evdev.InputEvent(sec, usec, event_type, code, value)
+
+
+class MidiSink:
+    """Stands in for an rtmidi output port, counting (and optionally printing or keeping) the messages sent to it."""
+
+    def __init__(self, debug=False, keep=False):
+        self.debug = debug
+        self.messages = 0
+        self.sent = [] if keep else None
+
+    def send_message(self, message):
+        self.messages += 1
+
+        if self.sent is not None:
+            self.sent.append(list(message))
+
+        if self.debug:
+            print("[MIDI sink] Channel: {}, CC: {}, Value: {}".format(*(hex(byte) for byte in message)))
+
+
+def record():
+    parser = argparse.ArgumentParser(description="Record events from a Traktor S4 mk1 to a file, until interrupted")
+    parser.add_argument("filename", help="File to write the recording to")
+    args = parser.parse_args()
+
+    traktor_s4 = midify.detect_controller_device()
+    midify.use_monotonic_timestamps(traktor_s4)
+    count = 0
+
+    with open(args.filename, "wb") as recording:
+        write_recording_header(recording)
+        print("Recording... (press Ctrl+C to stop)")
+
+        try:
+            for event in traktor_s4.read_loop():
+                write_recording_event(recording, event)
+                count += 1
+        except KeyboardInterrupt:
+            pass
+
+    traktor_s4.close()
+    print(f"Recorded {count} events to {args.filename}")
+
+
+def replay():
+    parser = argparse.ArgumentParser(description="Replay a recording through the event to MIDI translation pipeline")
+    parser.add_argument("filename", help="Recording made with traktor-s4-mk1-record")
+
+    parser.add_argument(
+        "-r",
+        "--realtime",
+        action="store_true",
+        help="Replay events with their original timing instead of as fast as possible",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jog_sensitivity",
+        type=int,
+        default=5,
+        help="Jog wheel sensitivity to translate with (min: 1, max: 100, default: 5)",
+    )
+
+    parser.add_argument(
+        "--jog_acceleration",
+        type=float,
+        default=0,
+        help="Jog wheel acceleration to translate with (default: 0)",
+    )
+
+    parser.add_argument(
+        "-p",
+        "--pot_hysteresis",
+        type=midify.pot_hysteresis,
+        default=0,
+        help="Pot hysteresis to translate with (max: 31, default: 0)",
+    )
+
+    parser.add_argument("-d", "--debug", action="store_true", help="Show debug log messages")
+    args = parser.parse_args()
+
+    midify.load_mappings()
+    state = midify.create_state(
+        args.jog_sensitivity * 1000000, jog_acceleration=args.jog_acceleration, pot_hysteresis=args.pot_hysteresis
+    )
+    coalescer = midify.EventFrameCoalescer()
+    sink = MidiSink()
+    log = None
+
+    if args.debug:
+        log = DebugLog()
+        log.start()
+
+    events = read_recording(args.filename)
+    frames = 0
+    first_event_ns = None
+    start = time.perf_counter()
+
+    while chunk := list(itertools.islice(events, 4096)):
+        for frame in coalescer.feed(chunk):
+            frames += 1
+
+            if args.realtime:
+                event_ns = midify.event_time_ns(frame[0])
+
+                if first_event_ns is None:
+                    first_event_ns = event_ns
+
+                delay = (event_ns - first_event_ns) / 1e9 - (time.perf_counter() - start)
+
+                if delay > 0:
+                    time.sleep(delay)
+
+            # Encoders are flushed as of each frame's timestamp rather than the current time, so that replaying a
+            # recording gives the same messages whether or not it's replayed in real time
+            midify.process_frame(frame, state, sink, log)
+
+    midify.flush_encoders(state, sink, None, log)
+    elapsed = time.perf_counter() - start
+
+    if log is not None:
+        log.stop()
+
+    print(f"Events: {coalescer.events_in} ({coalescer.events_out} after coalescing into {frames} frames)")
+    print(f"MIDI messages: {sink.messages} ({state['suppressed_messages']} suppressed as duplicates)")
+    print(f"Elapsed: {elapsed:.3f}s ({coalescer.events_in / elapsed if elapsed else 0:,.0f} events/s)")
+
+
+if __name__ == "__main__":
+    replay()
@@ -0,0 +1,157 @@
+# Latency histograms and event / message counters for the midify main loop. Nothing here is touched unless stats are
+# enabled, so the only cost when they're disabled is checking whether a Stats object exists.
+
+import array
+import os
+import signal
+import sys
+import threading
+import time
+
+
+class LatencyHistogram:
+    """Count of latencies in power of two nanosecond buckets, i.e. bucket n counts latencies below 2 ** n ns."""
+
+    def __init__(self):
+        self.buckets = array.array("Q", [0 for _ in range(64)])
+        self.count = 0
+        self.sum = 0
+
+    def record(self, latency_ns):
+        if latency_ns < 0:
+            latency_ns = 0
+
+        self.buckets[latency_ns.bit_length()] += 1
+        self.count += 1
+        self.sum += latency_ns
+
+    # Upper bound of the bucket the given fraction of latencies fall into, in nanoseconds.
+    def percentile(self, fraction):
+        target = fraction * self.count
+        seen = 0
+
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+
+            if count and seen >= target:
+                return 1 << bucket
+
+        return 0
+
+
+class Stats:
+    def __init__(self, clock=time.monotonic_ns):
+        # Must be the clock the kernel timestamps controller events with (see use_monotonic_timestamps in midify.py)
+        self.clock = clock
+        self.event_to_midi = LatencyHistogram()
+        self.midi_to_led = LatencyHistogram()
+        self.events = array.array("Q", [0 for _ in range(350)])
+        self.messages = array.array("Q", [0 for _ in range(350)])
+        self.suppressed = array.array("Q", [0 for _ in range(350)])
+        self.leds = None  # LedFramebuffers, one per controller
+
+    def format_text(self):
+        lines = []
+
+        for name, histogram in [("Event -> MIDI", self.event_to_midi), ("MIDI -> LED", self.midi_to_led)]:
+            if not histogram.count:
+                lines.append(f"[Stats] {name} latency: no samples")
+                continue
+
+            lines.append(
+                "[Stats] {} latency ({} samples): mean {:.0f}us, p50 <{}us, p99 <{}us, p999 <{}us".format(
+                    name,
+                    histogram.count,
+                    histogram.sum / histogram.count / 1000,
+                    histogram.percentile(0.5) // 1000,
+                    histogram.percentile(0.99) // 1000,
+                    histogram.percentile(0.999) // 1000,
+                )
+            )
+
+        for evcode, events in enumerate(self.events):
+            if events:
+                lines.append(
+                    "[Stats] Event code {}: {} events, {} MIDI messages, {} suppressed as duplicates".format(
+                        evcode, events, self.messages[evcode], self.suppressed[evcode]
+                    )
+                )
+
+        if self.leds is not None:
+            counts = [sum(getattr(leds, name) for leds in self.leds) for name in ["writes", "suppressed", "coalesced"]]
+            lines.append("[Stats] LED writes: {}, suppressed: {}, coalesced: {}".format(*counts))
+
+        return "\n".join(lines)
+
+    # Prometheus text exposition format, suitable for node_exporter's textfile collector.
+    def format_prometheus(self):
+        lines = []
+
+        for name, histogram in [("event_to_midi", self.event_to_midi), ("midi_to_led", self.midi_to_led)]:
+            metric = f"traktor_s4_{name}_latency_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+
+            # Trailing empty buckets are left out, since they'd all have the same cumulative count
+            last = max((bucket for bucket, count in enumerate(histogram.buckets) if count), default=-1)
+
+            for bucket in range(last + 1):
+                cumulative += histogram.buckets[bucket]
+                lines.append(f'{metric}_bucket{{le="{(1 << bucket) / 1e9:g}"}} {cumulative}')
+
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f"{metric}_sum {histogram.sum / 1e9:g}")
+            lines.append(f"{metric}_count {histogram.count}")
+
+        for name, counters in [
+            ("events", self.events),
+            ("midi_messages", self.messages),
+            ("suppressed_midi_messages", self.suppressed),
+        ]:
+            lines.append(f"# TYPE traktor_s4_{name}_total counter")
+
+            for evcode, count in enumerate(counters):
+                if count:
+                    lines.append(f'traktor_s4_{name}_total{{evcode="{evcode}"}} {count}')
+
+        if self.leds is not None:
+            lines.append("# TYPE traktor_s4_led_writes_total counter")
+
+            for result in ["writes", "suppressed", "coalesced"]:
+                count = sum(getattr(leds, result) for leds in self.leds)
+                lines.append(f'traktor_s4_led_writes_total{{result="{result}"}} {count}')
+
+        return "\n".join(lines) + "\n"
+
+
+def dump_stats_on_sigusr1(stats):
+    signal.signal(signal.SIGUSR1, lambda signum, frame: print(stats.format_text(), file=sys.stderr))
+
+
+class StatsFileWriter(threading.Thread):
+    """Periodically replace a file with the current stats in Prometheus text format."""
+
+    def __init__(self, stats, filename, interval=10):
+        super().__init__(name="stats-file-writer", daemon=True)
+        self.stats = stats
+        self.filename = filename
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        temporary_filename = f"{self.filename}.tmp"
+
+        with open(temporary_filename, "w") as stats_file:
+            stats_file.write(self.stats.format_prometheus())
+
+        # Rename over the old file so that readers never see a partially written one
+        os.replace(temporary_filename, self.filename)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.write()